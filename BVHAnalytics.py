@@ -0,0 +1,318 @@
+'''
+BVHAnalytics - vectorised QC statistics of BVH clips
+
+Usage Example:
+    bvhObject = BVHData()
+    bvhObject.bvhRead('01_01.bvh')
+    stats = BVHAnalytics.clipStats(bvhObject)              # one pass over the whole clip
+    print(stats['bounds'], stats['rootPathLength'], stats['footContacts'])
+
+    stats = BVHAnalytics.streamStats('huge.bvh')           # chunk by chunk with bvhStream
+
+    results, errors = BVHCorpus.loadCorpus('cmu', result='analytics') # the whole library
+
+    python BVHAnalytics.py 02_05.bvh                        # print the statistics of a file
+
+For a clip (stats for the clip, or per joint/channel in joint/channel order):
+    - bounds, jointBounds - (2,3) min and max of every joint coordinate, and (joints,2,3)
+                            per joint
+    - jointSpeedMean/Max  - joint speed (units per second), from frame to frame differences
+    - jointAccelerationMean/Max - magnitude of the joint acceleration (units per second^2)
+    - rootPathLength      - distance travelled by the root, and rootGroundPathLength the same
+                            on the ground (X,Z - Y is up, as in the CMU files)
+    - channelMin/Max/Mean/Std - statistics of every MOTION channel
+    - footContacts        - {foot joint: [(start, stop), ..]} frame ranges where the foot is
+                            within contactHeight of its lowest point and slower than contactSpeed
+    - jitter              - RMS distance of each joint from the midpoint of its positions in the
+                            frames either side (units) - high frequency noise
+    - outlierFrames       - frames where some joint is further than outlierThreshold x its
+                            jitter from that midpoint (pops and glitches), with outlierCounts
+                            the number of such frames per joint
+
+All of it is accumulated by ClipStats.update one chunk of frames at a time, as whole
+array operations - sums, maxima and merged means/variances carry over between chunks,
+and the last two frames of each chunk are kept for the differences. Only foot heights and
+speeds and the per joint midpoint distances are kept per frame (as float32), since contacts
+and outliers are decided against whole clip values. Results are the same for one chunk
+or many.
+'''
+
+import argparse
+
+import numpy as np
+
+from BVHData import BVHData
+
+def findFootJoints(jointNames):
+
+    # Default feet - joints named like '*foot*' or '*toe*' (any case)
+    return [name for name in jointNames if 'foot' in name.lower() or 'toe' in name.lower()]
+
+def legLength(bvhObject, footJoints):
+
+    # Longest chain of OFFSETs from the root to one of the foot joints - sets the scale of
+    # the default contact thresholds, whatever the units of the clip
+    lengths = np.linalg.norm(bvhObject.jointOffsets, axis=1)
+    longest = 0.0
+    for name in footJoints:
+        jointIndex, length = bvhObject.getJointIndex(name), 0.0
+        while bvhObject.jointParents[jointIndex] >= 0:
+            length += lengths[jointIndex]
+            jointIndex = bvhObject.jointParents[jointIndex]
+        longest = max(longest, length)
+
+    return longest
+
+class ClipStats:
+
+    def __init__(self, jointNames, channelNames=None, frameTime=1.0/120, footJoints=None, contactHeight=1.0,
+                 contactSpeed=1.0, minContactFrames=3, maxContactGap=3, outlierThreshold=8.0):
+
+        # jointNames - names of the joints, in the order of the joint coordinates passed to update
+        # channelNames - names of the MOTION channels passed to update (None if none are)
+        # frameTime - seconds per frame
+        # footJoints - names of the joints checked for contacts (default: findFootJoints)
+        # contactHeight, contactSpeed - a foot is in contact when it is within contactHeight of
+        #           its lowest height in the clip and slower than contactSpeed (units/second).
+        #           clipStats/streamStats set these from the leg length of the skeleton
+        # minContactFrames - shorter contacts are ignored
+        # maxContactGap - contacts less than this many frames apart are joined (speeds from frame
+        #           to frame differences are noisy)
+        # outlierThreshold - multiple of a joint's jitter that makes a frame an outlier
+        self.jointNames = list(jointNames)
+        self.channelNames = None if channelNames is None else list(channelNames)
+        self.frameTime = frameTime
+        self.footJoints = findFootJoints(self.jointNames) if footJoints is None else list(footJoints)
+        self.footIndices = [self.jointNames.index(name) for name in self.footJoints]
+        self.contactHeight = contactHeight
+        self.contactSpeed = contactSpeed
+        self.minContactFrames = minContactFrames
+        self.maxContactGap = maxContactGap
+        self.outlierThreshold = outlierThreshold
+
+        numJoints = len(self.jointNames)
+        self.totalFrames = 0
+        self.tail = np.zeros((0, numJoints, 3)) # last (up to) two frames of the previous chunk
+        self.jointMin = np.full((numJoints, 3), np.inf)
+        self.jointMax = np.full((numJoints, 3), -np.inf)
+        self.speedSum = np.zeros(numJoints)
+        self.speedMax = np.zeros(numJoints)
+        self.accelerationSum = np.zeros(numJoints)
+        self.accelerationMax = np.zeros(numJoints)
+        self.midpointSquareSum = np.zeros(numJoints)
+        self.rootPathLength = 0.0
+        self.rootGroundPathLength = 0.0
+
+        numChannels = 0 if channelNames is None else len(self.channelNames)
+        self.channelFrames = 0
+        self.channelMin = np.full(numChannels, np.inf)
+        self.channelMax = np.full(numChannels, -np.inf)
+        self.channelMean = np.zeros(numChannels)
+        self.channelM2 = np.zeros(numChannels) # sum of squared differences from the mean
+
+        # Kept per frame, as lists of chunks
+        self.footHeights = []
+        self.footSpeeds = []
+        self.midpointDistances = []
+
+    def update(self, jointCoords, motion=None):
+
+        '''
+        # Add a chunk of frames, following the frames added so far.
+        #
+        #   jointCoords - (frames, joints, 3) global joint coordinates (e.g. jointPositions)
+        #   motion      - (frames, channels) MOTION channels of the same frames, if channel
+        #                 statistics are wanted
+        '''
+        jointCoords = np.asarray(jointCoords, dtype=np.float64)
+        numFrames = jointCoords.shape[0]
+        if numFrames == 0:
+            return
+
+        self.jointMin = np.minimum(self.jointMin, jointCoords.min(axis=0))
+        self.jointMax = np.maximum(self.jointMax, jointCoords.max(axis=0))
+
+        # Differences reach back into the last frames of the previous chunk
+        coords = np.concatenate([self.tail, jointCoords])
+        steps = np.diff(coords, axis=0)
+        newSteps = steps[max(len(self.tail) - 1, 0):] # steps arriving at this chunk's frames
+        speeds = np.linalg.norm(newSteps, axis=2) / self.frameTime
+        if len(speeds):
+            self.speedSum += speeds.sum(axis=0)
+            self.speedMax = np.maximum(self.speedMax, speeds.max(axis=0))
+            self.rootPathLength += np.linalg.norm(newSteps[:,0], axis=1).sum()
+            self.rootGroundPathLength += np.linalg.norm(newSteps[:,0,[0,2]], axis=1).sum()
+
+        # Second differences, each belonging to the middle of its three frames
+        secondDiffs = np.linalg.norm(np.diff(steps, axis=0), axis=2)
+        if len(secondDiffs):
+            accelerations = secondDiffs / self.frameTime**2
+            self.accelerationSum += accelerations.sum(axis=0)
+            self.accelerationMax = np.maximum(self.accelerationMax, accelerations.max(axis=0))
+            midpointDistances = 0.5 * secondDiffs
+            self.midpointSquareSum += np.square(midpointDistances).sum(axis=0)
+            self.midpointDistances.append(midpointDistances.astype(np.float32))
+
+        # Foot heights of this chunk's frames, and the speed arriving at each (the first
+        # frame of the clip has none - it is given the speed of the second in result)
+        self.footHeights.append(jointCoords[:,self.footIndices,1].astype(np.float32))
+        if self.totalFrames == 0:
+            footSpeeds = np.concatenate([np.full((1, len(self.footIndices)), np.nan), speeds[:,self.footIndices]])
+        else:
+            footSpeeds = speeds[:,self.footIndices]
+        self.footSpeeds.append(footSpeeds.astype(np.float32))
+
+        self.tail = coords[-2:].copy()
+        self.totalFrames += numFrames
+
+        if motion is not None:
+            self.updateChannels(np.asarray(motion, dtype=np.float64))
+
+    def updateChannels(self, motion):
+
+        # Merge the channel statistics of a chunk into the running ones (Chan et al.'s
+        # pairwise update of the mean and sum of squared differences)
+        numFrames = motion.shape[0]
+        if numFrames == 0:
+            return
+
+        self.channelMin = np.minimum(self.channelMin, motion.min(axis=0))
+        self.channelMax = np.maximum(self.channelMax, motion.max(axis=0))
+
+        chunkMean = motion.mean(axis=0)
+        chunkM2 = np.square(motion - chunkMean).sum(axis=0)
+        totalFrames = self.channelFrames + numFrames
+        delta = chunkMean - self.channelMean
+        self.channelMean += delta * numFrames / totalFrames
+        self.channelM2 += chunkM2 + np.square(delta) * self.channelFrames * numFrames / totalFrames
+        self.channelFrames = totalFrames
+
+    def findContacts(self):
+
+        # {foot joint: [(start, stop), ..]} frame ranges of foot contacts
+        heights = np.concatenate(self.footHeights) if self.footHeights else np.zeros((0, len(self.footIndices)))
+        speeds = np.concatenate(self.footSpeeds) if self.footSpeeds else np.zeros((0, len(self.footIndices)))
+        if len(speeds) > 1:
+            speeds[0] = speeds[1]
+
+        contacts = {}
+        for foot, name in enumerate(self.footJoints):
+            inContact = np.zeros(len(heights) + 2, dtype=np.int8)
+            if len(heights):
+                inContact[1:-1] = (heights[:,foot] <= heights[:,foot].min() + self.contactHeight) & (speeds[:,foot] <= self.contactSpeed)
+            edges = np.diff(inContact)
+            starts, stops = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+            # joined[i] - contact i starts close enough to the end of contact i-1 to join it
+            joined = np.zeros(len(starts), dtype=bool)
+            joined[1:] = starts[1:] - stops[:-1] < self.maxContactGap
+            keepStops = np.ones(len(stops), dtype=bool)
+            keepStops[:-1] = ~joined[1:]
+            starts, stops = starts[~joined], stops[keepStops]
+            long = stops - starts >= self.minContactFrames
+            contacts[name] = list(zip(starts[long].tolist(), stops[long].tolist()))
+
+        return contacts
+
+    def result(self):
+
+        # Statistics of all the frames added, as a dict (see the module notes)
+        numJoints = len(self.jointNames)
+        speedFrames = max(self.totalFrames - 1, 1)
+        accelerationFrames = max(self.totalFrames - 2, 1)
+        jitter = np.sqrt(self.midpointSquareSum / accelerationFrames)
+
+        # Frames where a joint is further than outlierThreshold x its jitter from the midpoint
+        # of its neighbours (midpoint distances start at frame 1)
+        if self.midpointDistances:
+            isOutlier = np.concatenate(self.midpointDistances) > self.outlierThreshold * jitter
+        else:
+            isOutlier = np.zeros((0, numJoints), dtype=bool)
+
+        bounds = np.stack([self.jointMin.min(axis=0), self.jointMax.max(axis=0)]) if numJoints else np.zeros((2, 3))
+
+        stats = {'totalFrames': self.totalFrames,
+                 'frameTime': self.frameTime,
+                 'duration': self.totalFrames * self.frameTime,
+                 'jointNames': self.jointNames,
+                 'bounds': bounds,
+                 'jointBounds': np.stack([self.jointMin, self.jointMax], axis=1),
+                 'jointSpeedMean': self.speedSum / speedFrames,
+                 'jointSpeedMax': self.speedMax,
+                 'jointAccelerationMean': self.accelerationSum / accelerationFrames,
+                 'jointAccelerationMax': self.accelerationMax,
+                 'rootPathLength': self.rootPathLength,
+                 'rootGroundPathLength': self.rootGroundPathLength,
+                 'footContacts': self.findContacts(),
+                 'jitter': jitter,
+                 'outlierFrames': np.flatnonzero(isOutlier.any(axis=1)) + 1,
+                 'outlierCounts': isOutlier.sum(axis=0)}
+
+        if self.channelNames is not None:
+            stats['channelNames'] = self.channelNames
+            stats['channelMin'] = self.channelMin
+            stats['channelMax'] = self.channelMax
+            stats['channelMean'] = self.channelMean
+            stats['channelStd'] = np.sqrt(self.channelM2 / max(self.channelFrames, 1))
+
+        return stats
+
+def makeClipStats(bvhObject, contactHeight=0.1, contactSpeed=0.5, **kwargs):
+
+    # ClipStats for a clip read into bvhObject (its HIERARCHY at least). contactHeight and
+    # contactSpeed are fractions of the leg length (per second for the speed), so the
+    # defaults work whatever the units. Other arguments are passed on to ClipStats
+    jointNames = bvhObject.getJointNames()
+    channelNames = bvhObject.getChannelNames()
+    footJoints = kwargs.pop('footJoints', None)
+    if footJoints is None:
+        # Joint names need not be unique (End Site), so only keep the first of each
+        footJoints = [name for name in findFootJoints(jointNames) if name in bvhObject.jointIndexByName]
+    scale = legLength(bvhObject, footJoints)
+
+    return ClipStats(jointNames, channelNames, bvhObject.frameTime, footJoints, contactHeight * scale,
+                     contactSpeed * scale, **kwargs)
+
+def clipStats(bvhObject, chunkSize=None, **kwargs):
+
+    # Statistics of a clip read with bvhRead. With all poses computed this is a single pass
+    # over jointPositions and allMotion. A lazily read clip is evaluated chunkSize frames at
+    # a time (default poseBlockSize x poseCacheBlocks) so its poses are never all in memory.
+    # Arguments are as makeClipStats
+    stats = makeClipStats(bvhObject, **kwargs)
+
+    bvhObject.updatePoses()
+    if not bvhObject.lazy:
+        stats.update(bvhObject.jointPositions, bvhObject.allMotion)
+        return stats.result()
+
+    chunkSize = chunkSize or bvhObject.poseBlockSize * bvhObject.poseCacheBlocks
+    for start in range(0, bvhObject.totalFrames, chunkSize):
+        stop = min(start + chunkSize, bvhObject.totalFrames)
+        stats.update(bvhObject.getPoses(start, stop)[:,:,0:3,3], bvhObject.allMotion[start:stop])
+
+    return stats.result()
+
+def streamStats(bvhFileName, chunkSize=1024, **kwargs):
+
+    # Statistics of a BVH file read chunkSize frames at a time with bvhStream, for files too
+    # big to hold in memory. Arguments are as makeClipStats
+    bvhObject = BVHData()
+    stats = None
+    for startFrame, motion, transMats, jointCoords in bvhObject.bvhStream(bvhFileName, chunkSize):
+        if stats is None:
+            stats = makeClipStats(bvhObject, **kwargs)
+        stats.update(jointCoords, motion)
+
+    if stats is None: # no frames
+        stats = makeClipStats(bvhObject, **kwargs)
+
+    return stats.result()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the QC statistics of a BVH file')
+    parser.add_argument('bvhFileName')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='frames read at a time')
+    args = parser.parse_args()
+
+    for key, value in streamStats(args.bvhFileName, args.chunk_size).items():
+        print(key, value)
@@ -0,0 +1,272 @@
+'''
+BVHBenchmark - timing and memory benchmarks for BVHData
+
+Usage Example:
+    python BVHBenchmark.py --output results.json
+    python BVHBenchmark.py --baseline results.json --threshold 1.1
+
+Each phase of loading and drawing a clip is timed on its own:
+    - parse     - scanning the HIERARCHY and reading the MOTION block into allMotion
+    - hierarchy - building the skeleton (readHierarchy), with the skeleton template cache
+                  cleared first, as for the first clip of a rig
+    - hierarchyTemplate - the same with the template cached, as every clip after the
+                  first on the same rig is
+    - fk        - forward kinematics for every frame (computeAllPoses)
+    - fkThreads - the same, split into frame chunks over --fk-workers threads. Its
+                  speedup over fk is reported with it
+    - bindPose  - inverting the bind pose transforms (storeBindPoses)
+    - preview   - building the bone list for drawing (preCalculatePreview)
+    - render    - setting up the plots and drawing frames offscreen
+    - bvhRead   - the whole of bvhRead, end to end (with the template cache cleared)
+
+Phases are run on the bundled CMU clips and on synthetic clips that scale the
+number of frames, joints and the depth of the hierarchy. Every phase is run
+--repeat times (best and median wall time are reported), then once more under
+tracemalloc to measure its peak memory.
+
+Results are written as JSON. Given a --baseline JSON file from an earlier run,
+any phase slower (or using more memory) than threshold x the baseline is flagged
+and the exit status is 1, so it can be used to catch regressions.
+'''
+
+import argparse
+import collections
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg') # render offscreen
+import matplotlib.pyplot as plt
+import numpy as np
+
+from BVHData import BVHData, clearSkeletonCache
+
+BUNDLED_FILES = ['01_01.bvh', '02_05.bvh']
+ROTATION_ORDERS = ['XYZ', 'XZY', 'YXZ', 'YZX', 'ZXY', 'ZYX']
+
+def makeSyntheticBVH(fileName, numFrames=1000, numJoints=31, depth=5, seed=0, frameTime=1.0/120):
+
+    # Write a random (but reproducible) BVH file. The root has position and rotation
+    # channels, the other numJoints-1 joints hang off it in chains of up to depth joints,
+    # each ending in an End Site. Rotation orders are mixed across all six orders.
+    rng = np.random.default_rng(seed)
+    lines = ['HIERARCHY', 'ROOT root', '{', '  OFFSET 0 0 0']
+    rootOrder = ROTATION_ORDERS[rng.integers(6)]
+    lines.append('  CHANNELS 6 Xposition Yposition Zposition ' + ' '.join([axis + 'rotation' for axis in rootOrder]))
+
+    jointCount = 1
+    while jointCount < numJoints:
+        chainLength = min(depth, numJoints - jointCount)
+        for level in range(1, chainLength + 1):
+            indent = '  ' * level
+            order = ROTATION_ORDERS[rng.integers(6)]
+            offset = rng.uniform(-10, 10, 3)
+            lines += [indent + 'JOINT joint{}'.format(jointCount), indent + '{',
+                      indent + '  OFFSET {:.6f} {:.6f} {:.6f}'.format(*offset),
+                      indent + '  CHANNELS 3 ' + ' '.join([axis + 'rotation' for axis in order])]
+            jointCount += 1
+        indent = '  ' * (chainLength + 1)
+        lines += [indent + 'End Site', indent + '{', indent + '  OFFSET 0 1 0', indent + '}']
+        for level in range(chainLength, 0, -1):
+            lines.append('  ' * level + '}')
+    lines.append('}')
+
+    lines += ['MOTION', 'Frames:\t{}'.format(numFrames), 'Frame Time:\t{:.8f}'.format(frameTime)]
+
+    motion = rng.uniform(-45, 45, (numFrames, 3 + 3 * numJoints))
+    motion[:,0:3] = np.cumsum(rng.normal(0, 0.5, (numFrames, 3)), axis=0)
+
+    with open(fileName, 'w') as bvhFile:
+        bvhFile.write('\n'.join(lines) + '\n')
+        np.savetxt(bvhFile, motion, fmt='%.6f')
+
+    return fileName
+
+def makePhases(fileName, renderFrames=20, fkWorkers=None, fkChunkSize=None):
+
+    # The phases to time for one file, in the order they must run (later phases use
+    # the state left by earlier ones)
+    bvhObject = BVHData()
+    bvhObject.fileName = fileName
+
+    def parse():
+        with open(fileName) as bvhFile:
+            bvhObject.readHierarchyLines(bvhFile)
+            bvhObject.readMotion(bvhFile, len(bvhObject.allLines))
+
+    def hierarchy():
+        clearSkeletonCache()
+        bvhObject.readHierarchy()
+
+    def fkThreads():
+        bvhObject.computeAllPoses(fkWorkers or os.cpu_count() or 1, fkChunkSize)
+
+    def bindPose():
+        bvhObject.bindPoseFrame = 0
+        bvhObject.storeBindPoses()
+
+    def render():
+        bvhObject.setupPlots()
+        for frame in range(renderFrames):
+            bvhObject.drawSkeleton(frame)
+            bvhObject.fig.canvas.draw()
+        plt.close(bvhObject.fig)
+
+    def bvhRead():
+        clearSkeletonCache()
+        BVHData().bvhRead(fileName)
+
+    phases = collections.OrderedDict()
+    phases['parse'] = parse
+    phases['hierarchy'] = hierarchy
+    phases['hierarchyTemplate'] = bvhObject.readHierarchy
+    phases['fk'] = bvhObject.computeAllPoses
+    phases['fkThreads'] = fkThreads
+    phases['bindPose'] = bindPose
+    phases['preview'] = bvhObject.preCalculatePreview
+    phases['render'] = render
+    phases['bvhRead'] = bvhRead
+
+    return phases
+
+def timePhase(phase, repeat=3):
+
+    # Best and median wall time over repeat runs, then peak memory from one more run
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        phase()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    phase()
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': min(times), 'median': statistics.median(times), 'peakMB': peakBytes / 1e6}
+
+def benchmarkFile(fileName, repeat=3, renderFrames=20, fkWorkers=None, fkChunkSize=None):
+
+    # Time every phase for one file
+    results = collections.OrderedDict()
+    for phaseName, phase in makePhases(fileName, renderFrames, fkWorkers, fkChunkSize).items():
+        results[phaseName] = timePhase(phase, repeat)
+    results['fkThreads']['speedup'] = results['fk']['seconds'] / max(results['fkThreads']['seconds'], 1e-12)
+
+    return results
+
+def syntheticCases(quick=False):
+
+    # (case name, frames, joints, depth) - scale each of frames, joints and depth on its own
+    if quick:
+        frameCounts, jointCounts, depths = [500, 2000], [16, 64], [4, 16]
+    else:
+        frameCounts, jointCounts, depths = [1000, 4000, 16000], [16, 64, 256], [4, 16, 64]
+
+    cases = []
+    for numFrames in frameCounts:
+        cases.append(('synthetic-frames{}'.format(numFrames), numFrames, 31, 5))
+    for numJoints in jointCounts:
+        cases.append(('synthetic-joints{}'.format(numJoints), 1000, numJoints, 5))
+    for depth in depths:
+        cases.append(('synthetic-depth{}'.format(depth), 1000, 64, depth))
+
+    return cases
+
+def runBenchmarks(repeat=3, quick=False, renderFrames=20, seed=0, fkWorkers=None, fkChunkSize=None):
+
+    # Run the whole suite and return the results as a JSON ready dict
+    results = collections.OrderedDict()
+    packageDir = os.path.dirname(os.path.abspath(__file__))
+
+    for fileName in BUNDLED_FILES:
+        print('Benchmarking', fileName, file=sys.stderr)
+        results[fileName] = benchmarkFile(os.path.join(packageDir, fileName), repeat, renderFrames, fkWorkers, fkChunkSize)
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        for caseName, numFrames, numJoints, depth in syntheticCases(quick):
+            print('Benchmarking', caseName, file=sys.stderr)
+            fileName = makeSyntheticBVH(os.path.join(tempDir, caseName + '.bvh'), numFrames, numJoints, depth, seed)
+            results[caseName] = benchmarkFile(fileName, repeat, renderFrames, fkWorkers, fkChunkSize)
+
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'platform': platform.platform(),
+                     'repeat': repeat,
+                     'quick': quick,
+                     'cpus': os.cpu_count(),
+                     'fkWorkers': fkWorkers or os.cpu_count() or 1,
+                     'fkChunkSize': fkChunkSize or BVHData().fkChunkSize},
+            'results': results}
+
+def compareResults(results, baseline, threshold=1.1, minSeconds=1e-3):
+
+    # List of regressions - phases slower (by more than minSeconds) or with a bigger
+    # memory peak than threshold x the baseline. Cases/phases missing from either are skipped
+    regressions = []
+    for caseName, phases in results['results'].items():
+        for phaseName, result in phases.items():
+            old = baseline['results'].get(caseName, {}).get(phaseName)
+            if old is None:
+                continue
+            if result['seconds'] > old['seconds'] * threshold and result['seconds'] - old['seconds'] > minSeconds:
+                regressions.append('{} {}: {:.4f}s -> {:.4f}s ({:.2f}x)'.format(
+                    caseName, phaseName, old['seconds'], result['seconds'], result['seconds'] / old['seconds']))
+            if result['peakMB'] > old['peakMB'] * threshold and result['peakMB'] - old['peakMB'] > 1:
+                regressions.append('{} {}: peak {:.1f}MB -> {:.1f}MB'.format(
+                    caseName, phaseName, old['peakMB'], result['peakMB']))
+
+    return regressions
+
+def printResults(results, baseline=None):
+
+    # Human readable table (the JSON file is the machine readable version)
+    print('{:<24}{:<18}{:>11}{:>11}{:>10}{:>9}'.format('case', 'phase', 'best (s)', 'median (s)', 'peak MB', 'vs base'))
+    for caseName, phases in results['results'].items():
+        for phaseName, result in phases.items():
+            ratio = ''
+            if baseline is not None and phaseName in baseline['results'].get(caseName, {}):
+                ratio = '{:.2f}x'.format(result['seconds'] / max(baseline['results'][caseName][phaseName]['seconds'], 1e-12))
+            if 'speedup' in result:
+                ratio += ' ({:.2f}x fk)'.format(result['speedup'])
+            print('{:<24}{:<18}{:>11.4f}{:>11.4f}{:>10.1f}{:>9}'.format(
+                caseName, phaseName, result['seconds'], result['median'], result['peakMB'], ratio))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark BVHData parsing, FK and drawing')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.1, help='slowdown ratio flagged as a regression')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per phase')
+    parser.add_argument('--render-frames', type=int, default=20, help='frames drawn in the render phase')
+    parser.add_argument('--quick', action='store_true', help='smaller synthetic clips')
+    parser.add_argument('--fk-workers', type=int, help='threads for the fkThreads phase (default: one per core)')
+    parser.add_argument('--fk-chunk-size', type=int, help='frames per chunk in the fkThreads phase (default: BVHData.fkChunkSize)')
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.repeat, args.quick, args.render_frames, fkWorkers=args.fk_workers,
+                            fkChunkSize=args.fk_chunk_size)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+
+    printResults(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2)
+
+    if baseline is not None:
+        regressions = compareResults(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        sys.exit(1 if regressions else 0)
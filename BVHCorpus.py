@@ -0,0 +1,126 @@
+'''
+BVHCorpus - load whole directories of BVH files
+
+Usage Example:
+    import BVHCorpus
+    results, errors = BVHCorpus.loadCorpus('cmu/*.bvh', result='positions', workers=8)
+    for fileName, clip in results.items():
+        print(fileName, clip['jointPositions'].shape)
+
+Clips are read with BVHData in a pool of worker processes. Only compact numpy
+results are sent back from the workers (never the Node hierarchy):
+
+    - 'summary'   - frame count, frame time, duration, joint and channel counts, the skeleton
+                    fingerprint (equal for clips on the same rig, whose arrays line up), and
+                    the BVHData load timings and counters (handy for finding the slowest files)
+    - 'motion'    - the summary plus the raw MOTION channels (allMotion) and channel names
+    - 'positions' - the summary plus joint names and (frames, joints, 3) joint positions
+    - 'rotations' - the summary plus joint names and (frames, joints, D) joint rotations in
+                    the chosen representation (see BVHData.getRotations)
+    - 'analytics' - the summary plus QC statistics (bounds, speeds, foot contacts, jitter and
+                    outlier frames - see BVHAnalytics.clipStats), evaluated in chunks of frames
+
+A file that fails to load does not stop the batch - its error message is
+returned in the errors dict instead.
+'''
+
+import concurrent.futures
+import glob
+import os
+
+import numpy as np
+
+from BVHData import BVHData
+import BVHAnalytics
+
+RESULT_TYPES = ('summary', 'motion', 'positions', 'rotations', 'analytics')
+
+def findCorpusFiles(corpusPath, pattern='*.bvh'):
+
+    # A directory (searched recursively for pattern) or a glob, e.g. 'cmu/**/*.bvh'.
+    # Returns a sorted list of file names
+    if os.path.isdir(corpusPath):
+        return sorted(glob.glob(os.path.join(corpusPath, '**', pattern), recursive=True))
+
+    return sorted(glob.glob(corpusPath, recursive=True))
+
+def loadClip(fileName, result='positions', dtype=np.float32, useCache=False, representation='quaternion',
+             space='local'):
+
+    # Read one clip and reduce it to the requested result type. Runs in the workers, so
+    # errors are returned (as text) rather than raised.
+    try:
+        bvhObject = BVHData(dtype=dtype)
+        # Only positions and global rotations need every pose up front (analytics evaluates
+        # the lazily read poses a chunk at a time)
+        needPoses = result == 'positions' or (result == 'rotations' and space == 'global')
+        bvhObject.bvhRead(fileName, lazy=not needPoses, useCache=useCache)
+
+        clip = {'totalFrames': bvhObject.totalFrames,
+                'frameTime': bvhObject.frameTime,
+                'duration': bvhObject.totalFrames * bvhObject.frameTime,
+                'totalJoints': bvhObject.totalJoints,
+                'totalChannels': bvhObject.allMotion.shape[1],
+                'skeleton': bvhObject.skeleton.fingerprint,
+                'timings': dict(bvhObject.timings),
+                'counters': dict(bvhObject.counters)}
+
+        if result == 'motion':
+            clip['allMotion'] = np.asarray(bvhObject.allMotion)
+            clip['channelNames'] = bvhObject.getChannelNames()
+
+        if result in ('positions', 'rotations'):
+            clip['jointNames'] = bvhObject.getJointNames()
+        
+        if result == 'positions':
+            clip['jointPositions'] = np.asarray(bvhObject.jointPositions)
+        
+        if result == 'rotations':
+            clip['rotations'] = bvhObject.getRotations(representation, space, dtype=dtype)
+
+        if result == 'analytics':
+            clip['analytics'] = BVHAnalytics.clipStats(bvhObject)
+
+        return fileName, clip, None
+
+    except Exception as error:
+        return fileName, None, '{}: {}'.format(type(error).__name__, error)
+
+def loadCorpus(corpusPath, result='positions', workers=None, chunkSize=1, pattern='*.bvh',
+               dtype=np.float32, useCache=False, representation='quaternion', space='local'):
+
+    '''
+    # Load every BVH file in a directory (or matching a glob) in parallel.
+    #
+    #   result    - 'summary', 'motion', 'positions', 'rotations' or 'analytics' (see module notes)
+    #   workers   - number of worker processes (default: one per core). 0 loads in this process
+    #   chunkSize - files handed to a worker at a time. Larger chunks cut scheduling overhead
+    #               for corpora of many small clips
+    #   dtype     - precision of the joint positions/rotations sent back
+    #   useCache  - read/write the BVHData binary cache for each clip
+    #   representation, space - rotation format for result='rotations': 'quaternion', 'matrix',
+    #               '6d' or 'axisAngle', in 'local' or 'global' space
+    #
+    # Returns (results, errors), both dicts keyed by file name, in file name order.
+    '''
+    if result not in RESULT_TYPES:
+        raise ValueError('result must be one of {}, not {!r}'.format(RESULT_TYPES, result))
+
+    fileNames = findCorpusFiles(corpusPath, pattern)
+    args = [(fileName, result, dtype, useCache, representation, space) for fileName in fileNames]
+
+    if workers == 0:
+        loaded = [loadClip(*arg) for arg in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            loaded = list(pool.map(loadClip, *zip(*args), chunksize=chunkSize)) if args else []
+
+    results = {}
+    errors = {}
+    for fileName, clip, error in loaded:
+        if error is None:
+            results[fileName] = clip
+        else:
+            errors[fileName] = error
+
+    return results, errors
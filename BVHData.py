@@ -23,6 +23,9 @@ The rootNode then starts the hierarchy of joints/nodes with associated data:
 Other notes:
     - Will read a BVH file into a hierarchical format
     - Will store animation sequences for joints in place in a np array
+    - Clips with the same HIERARCHY share one read-only Skeleton (names, offsets, channels
+      and topology) from a process wide template cache, so the HIERARCHY is parsed once
+      and the Nodes are only made if used. Their arrays can be batched with stackClips
     - Of course, to understand this code you have to first understand how a 
     - BVH file is constructed. I would start with these excellent resources:
         https://research.cs.wisc.edu/graphics/Courses/cs-838-1999/Jeff/BVH.html
@@ -31,14 +34,45 @@ Other notes:
 
 import numpy as np
 import sys
+import collections
+import itertools
+import os
+import json
+import hashlib
 from mpl_toolkits import mplot3d
 import matplotlib.pyplot as plt
 import math
 import time
+import warnings
+import logging
+import contextlib
 import matplotlib.animation as animation
+import matplotlib.figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+import concurrent.futures
+import shutil
+import subprocess
+import threading
+import types
+
+import BVHRotations
+
+CACHE_VERSION = 2 # bump when the layout of bvhRead cache entries changes
+SKELETON_CACHE_SIZE = 256 # distinct skeletons kept in the process wide template cache (see getSkeleton)
+
+# Progress is reported through logging - INFO per file, DEBUG per joint and per phase timing.
+# Nothing is shown unless the application configures logging (see __main__)
+logger = logging.getLogger('BVHData')
 
 class Node:
     
+    # Nodes are created for every joint of every clip, so keep them small. The global
+    # transforms and joint coordinates are not stored on the Node, they are read-only
+    # views into the contiguous arrays owned by the BVHData object the Node belongs to.
+    __slots__ = ['childNodes', 'numChannels', 'channelNames', 'animation', 'offset', 'name',
+                 'channelIndices', 'jointIndex', 'bvhData']
+    
     def __init__(self):
         self.childNodes = []
         self.numChannels = 0
@@ -46,14 +80,228 @@ class Node:
         self.animation = [] # this is rotation information for joints
         self.offset = []
         self.name = "Joint Name"   
-        self.transMats = []           
-        self.jointCoords = []
         self.channelIndices = []
+        self.jointIndex = -1 # index of this joint in the BVHData pose arrays
+        self.bvhData = None # the BVHData object owning the pose arrays
+
+    @property
+    def transMats(self):
+        # (frames,4,4) global transforms of this joint. In lazy mode these are evaluated
+        # block by block (see getJointPoses) and copied, as there is no whole clip array
+        if self.bvhData is None:
+            return []
+        if self.bvhData.lazy:
+            return self.bvhData.getJointPoses(self.jointIndex)
+        self.bvhData.updatePoses()
+        view = self.bvhData.globalTransMats[:,self.jointIndex]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def jointCoords(self):
+        # (frames,3) global coordinates of this joint
+        if self.bvhData is None:
+            return []
+        if self.bvhData.lazy:
+            return self.bvhData.getJointPoses(self.jointIndex)[:,0:3,3]
+        self.bvhData.updatePoses()
+        view = self.bvhData.jointPositions[:,self.jointIndex]
+        view.flags.writeable = False
+        return view
+
+def channelLayout(channelNames):
+    
+    # Work out where the rotation and position channels live for a joint.
+    # Returns the rotation order as a string in the order it is applied (e.g. 'ZXY'),
+    # the columns of the rotation channels and the columns of the X/Y/Z position
+    # channels (empty if the joint has no translation channels)
+    rotCols = [i for i in range(len(channelNames)) if channelNames[i].endswith('rotation')]
+    rotOrder = ''.join([channelNames[i][0] for i in rotCols])
+    
+    posCols = []
+    if all(axis + 'position' in channelNames for axis in 'XYZ'):
+        posCols = [channelNames.index(axis + 'position') for axis in 'XYZ']
+    
+    return rotOrder, rotCols, posCols
+
+def readOnly(array):
+    
+    array.flags.writeable = False
+    return array
+
+class Skeleton:
+    
+    # The joints of a HIERARCHY - names, offsets, channels and topology - as flat arrays in
+    # joint (file) order, with everything forward kinematics needs worked out once. Clips
+    # with the same HIERARCHY share one Skeleton from the template cache (see getSkeleton),
+    # so it is immutable: the arrays are read-only and the dicts are read-only views.
+    # Pickling (and copying) goes through getSkeleton, so the views are rebuilt and an
+    # unpickled Skeleton is the shared template in the receiving process too.
+    def __init__(self, names, offsets, channelNames, parents, fingerprint=None):
+        numJoints = len(names)
+        self.names = tuple(names)
+        self.channelNames = tuple(tuple(jointChannels) for jointChannels in channelNames)
+        self.offsets = readOnly(np.asarray(offsets, dtype=np.float64).reshape(numJoints, 3))
+        self.parents = readOnly(np.asarray(parents, dtype=np.intp).reshape(numJoints))
+        self.fingerprint = fingerprint or skeletonFingerprint(names, offsets, channelNames, parents)
+        self.numJoints = numJoints
+        
+        indexByName = {}
+        for jointIndex, name in enumerate(self.names):
+            indexByName.setdefault(name, jointIndex)
+        self.jointIndexByName = types.MappingProxyType(indexByName) # the first joint of each name
+        
+        channelStops = np.cumsum([len(jointChannels) for jointChannels in self.channelNames], dtype=np.intp)
+        self.numChannels = int(channelStops[-1]) if numJoints else 0
+        self.channelSlices = tuple(slice(int(stop) - len(jointChannels), int(stop))
+                                   for stop, jointChannels in zip(channelStops, self.channelNames))
+        
+        # Joints are in file (depth first) order, so each subtree is a contiguous range of
+        # joints and a single pass in order sees every parent before its children
+        depths = np.zeros(numJoints, dtype=np.intp)
+        for jointIndex in range(1, numJoints):
+            depths[jointIndex] = depths[self.parents[jointIndex]] + 1
+        numLevels = int(depths.max()) + 1 if numJoints else 0
+        self.depths = readOnly(depths)
+        self.levels = tuple(readOnly(np.flatnonzero(depths == depth)) for depth in range(numLevels))
+        
+        subtreeStops = np.arange(1, numJoints + 1, dtype=np.intp)
+        for jointIndex in range(numJoints - 1, 0, -1):
+            parent = self.parents[jointIndex]
+            subtreeStops[parent] = max(subtreeStops[parent], subtreeStops[jointIndex])
+        self.subtreeStops = readOnly(subtreeStops)
+        
+        # Channel layout of every joint, grouped for batched evaluation
+        groups = collections.defaultdict(lambda: ([], []))
+        positionJoints, positionColumns = [], []
+        for jointIndex, (jointChannels, channelSlice) in enumerate(zip(self.channelNames, self.channelSlices)):
+            rotOrder, rotCols, posCols = channelLayout(jointChannels)
+            groups[rotOrder][0].append(jointIndex)
+            groups[rotOrder][1].append([channelSlice.start + col for col in rotCols])
+            if posCols:
+                positionJoints.append(jointIndex)
+                positionColumns.append([channelSlice.start + col for col in posCols])
+        
+        rotationGroups = {}
+        for rotOrder, (jointIndices, columns) in groups.items():
+            columns = np.asarray(columns, dtype=np.intp).reshape(len(jointIndices), len(rotOrder))
+            rotationGroups[rotOrder] = (readOnly(np.asarray(jointIndices, dtype=np.intp)), readOnly(columns))
+        self.rotationGroups = types.MappingProxyType(rotationGroups)
+        self.positionJoints = readOnly(np.asarray(positionJoints, dtype=np.intp))
+        self.positionColumns = readOnly(np.asarray(positionColumns, dtype=np.intp).reshape(len(positionJoints), 3))
+
+    def __reduce__(self):
+        return getSkeleton, (list(self.names), np.array(self.offsets), [list(jointChannels) for jointChannels in self.channelNames],
+                             self.parents.tolist())
+
+def skeletonFingerprint(names, offsets, channelNames, parents):
+    
+    # Hash identifying a skeleton by its joint names, offsets, channel orders and topology
+    definition = [list(names), np.asarray(offsets, dtype=np.float64).tolist(),
+                  [list(jointChannels) for jointChannels in channelNames], [int(parent) for parent in parents]]
+    return hashlib.sha1(json.dumps(definition).encode('utf-8')).hexdigest()
+
+# Process wide template cache. Skeletons by fingerprint, and the same Skeletons by a hash of
+# the HIERARCHY text they were read from, so a HIERARCHY seen before is not parsed again.
+# Both are LRU ordered and hold at most SKELETON_CACHE_SIZE entries
+skeletonTemplates = collections.OrderedDict()
+hierarchyTemplates = collections.OrderedDict()
+templateLock = threading.Lock()
+
+def cacheTemplate(templates, key, skeleton):
+    
+    # Add (or refresh) a template cache entry, dropping the least recently used. Returns
+    # the entry already there for key if there is one, else skeleton
+    with templateLock:
+        skeleton = templates.setdefault(key, skeleton)
+        templates.move_to_end(key)
+        while len(templates) > SKELETON_CACHE_SIZE:
+            templates.popitem(last=False)
+    return skeleton
+
+def getSkeleton(names, offsets, channelNames, parents):
+    
+    # The shared Skeleton with these joints (per joint lists in file order) - from the
+    # template cache, or made and added to it
+    fingerprint = skeletonFingerprint(names, offsets, channelNames, parents)
+    with templateLock:
+        skeleton = skeletonTemplates.get(fingerprint)
+    if skeleton is None:
+        skeleton = Skeleton(names, offsets, channelNames, parents, fingerprint)
+    return cacheTemplate(skeletonTemplates, fingerprint, skeleton)
+
+def hierarchyKey(hierarchyLines):
+    
+    return hashlib.sha1('\n'.join(hierarchyLines).encode('utf-8')).digest()
+
+def findHierarchyTemplate(hierarchyLines):
+    
+    # The Skeleton read from exactly this HIERARCHY text before, or None
+    key = hierarchyKey(hierarchyLines)
+    with templateLock:
+        skeleton = hierarchyTemplates.get(key)
+        if skeleton is not None:
+            hierarchyTemplates.move_to_end(key)
+    return skeleton
+
+def addHierarchyTemplate(hierarchyLines, skeleton):
+    
+    cacheTemplate(hierarchyTemplates, hierarchyKey(hierarchyLines), skeleton)
+
+def clearSkeletonCache():
+    
+    # Empty the template cache (clips already read keep their Skeletons)
+    with templateLock:
+        skeletonTemplates.clear()
+        hierarchyTemplates.clear()
+
+def stackClips(bvhObjects, arrayName='allMotion', padded=True):
+    
+    '''
+    # Stack the same array of several clips into one batched array. The clips must have the
+    # same skeleton (as clips sharing a Skeleton template do), so their channels and joints
+    # line up.
+    #
+    #   arrayName - 'allMotion' (frames, channels), 'globalTransMats' (frames, joints, 4, 4)
+    #               or 'jointPositions' (frames, joints, 3). Lazily read clips are evaluated
+    #   padded    - if True, return a (clips, most frames, ...) array with shorter clips
+    #               zero padded at the end. If False, the clips are concatenated along the
+    #               frame axis into a (total frames, ...) array
+    #
+    # Returns (stacked, lengths) where lengths holds the number of frames of each clip.
+    '''
+    if not bvhObjects:
+        raise ValueError('No clips to stack')
+    fingerprints = set([None if bvhObject.skeleton is None else bvhObject.skeleton.fingerprint for bvhObject in bvhObjects])
+    if len(fingerprints) > 1:
+        raise ValueError('Clips with different skeletons can not be stacked')
+    if arrayName not in ('allMotion', 'globalTransMats', 'jointPositions'):
+        raise ValueError('arrayName must be allMotion, globalTransMats or jointPositions, not {!r}'.format(arrayName))
+    
+    arrays = []
+    for bvhObject in bvhObjects:
+        if arrayName == 'allMotion':
+            arrays.append(bvhObject.allMotion)
+        elif arrayName == 'globalTransMats' or bvhObject.lazy:
+            poses = bvhObject.getPoses()
+            arrays.append(poses if arrayName == 'globalTransMats' else poses[:,:,0:3,3])
+        else:
+            bvhObject.updatePoses()
+            arrays.append(bvhObject.jointPositions)
+    lengths = np.asarray([array.shape[0] for array in arrays], dtype=np.intp)
+    
+    if not padded:
+        return np.concatenate(arrays), lengths
+    
+    stacked = np.zeros((len(arrays), lengths.max()) + arrays[0].shape[1:], dtype=np.result_type(*arrays))
+    for clipIndex, array in enumerate(arrays):
+        stacked[clipIndex,:array.shape[0]] = array
+    
+    return stacked, lengths
 
 class BVHData:
 
-    def __init__(self, bvhFileName = 'Empty'):
-        self.root = Node()
+    def __init__(self, bvhFileName = 'Empty', dtype = np.float64):
         self.lineIter=0
         self.allLines = []
         self.nodeStack = []
@@ -68,10 +316,26 @@ class BVHData:
         self.jointPlots = []
         self.bonePlots = []
         self.bindTfrms = [] #Store the joint bind poses - makes skinning easier       
+        self.resetTopology()
         self.bindPoseFrame = -1        
+        self.dtype = np.dtype(dtype) # pose storage precision - np.float32 halves the memory
+        self.globalTransMats = np.zeros((0,0,4,4), dtype=self.dtype) # (frames, joints, 4, 4)
+        self.jointPositions = np.zeros((0,0,3), dtype=self.dtype) # (frames, joints, 3)
+        self.lazy = False # poses are evaluated on demand (see bvhRead)
+        self.poseBlockSize = 64 # frames evaluated together in lazy mode
+        self.poseCacheBlocks = 32 # number of frame blocks kept in the LRU pose cache
+        self.poseCache = collections.OrderedDict()
+        self.dirtyRanges = [] # (jointIndex, start, stop) edits not yet applied to the poses (see updatePoses)
+        self.fkWorkers = 1 # threads evaluating chunks of frames in forward kinematics
+        self.fkChunkSize = 256 # frames evaluated together by forward kinematics (small enough to stay in cache)
+        self.cacheDir = None # where bvhRead(useCache=True) keeps cache entries (None = next to the file)
+        self.cacheHashContents = False # also key cache entries on a hash of the file contents
+        self.statsCallback = None # called as statsCallback(bvhObject, phaseName, seconds) after each phase
+        self.profilerHook = None # called as profilerHook(phaseName) - returns a context manager wrapping the phase
+        self.resetStats()
         
     
-    def bvhRead(self, bvhFileName):
+    def bvhRead(self, bvhFileName, lazy=False, useCache=False, fkWorkers=None, fkChunkSize=None):
         
         '''
         # NB - Default assumes no bind pose is given in the BVH file.
@@ -82,55 +346,459 @@ class BVHData:
         # I'm doing this so that when I create the Node hierarchy I can store the
         # motion data for a Node on the fly in the first pass (and not have to DFS)
         # the hierarchy again later, adding the MOTION data.
+        #
+        #   lazy - if True, only the HIERARCHY and the raw MOTION channels are read. No
+        #          transforms are computed up front - use getPose/getPoses/getJointPoses (or
+        #          Node.transMats/jointCoords) to evaluate frames on demand (recently used
+        #          frame blocks are kept in an LRU cache), or computeAllPoses to switch to
+        #          the fully evaluated arrays.
+        #
+        #   useCache - if True, keep a binary copy of the parsed clip (and its poses, unless
+        #          lazy) in a cache entry next to the file, or in cacheDir if set. Later reads
+        #          memory-map the cache instead of parsing the text. The entry is keyed on
+        #          the file path, size and modification time (and a hash of the contents if
+        #          cacheHashContents is set) and is rebuilt when the file changes.
+        #
+        #   fkWorkers, fkChunkSize - if given, set the fkWorkers/fkChunkSize attributes: forward
+        #          kinematics (here and in any later recompute) splits the frames into chunks of
+        #          fkChunkSize evaluated by fkWorkers threads, e.g. fkWorkers=os.cpu_count()
+        #          for multi-hour takes. The default is one thread.
+        #
+        # Time spent in each phase is added up in timings, and counts of the work done
+        # (lines parsed, joints, frames, matmuls..) are kept in counters - see resetStats.
         
         '''
-        print('Reading BVH File..', bvhFileName)
+        logger.info('Reading BVH File.. %s', bvhFileName)
         
-        bvhFile = open(bvhFileName)                     
         self.fileName = bvhFileName
+        self.resetStats()
+        self.dirtyRanges = []
+        if fkWorkers is not None:
+            self.fkWorkers = fkWorkers
+        if fkChunkSize is not None:
+            self.fkChunkSize = fkChunkSize
         
-        self.allLines = bvhFile.read().split("\n") # Split each line by \n
-        numLines = len(self.allLines) 
-        nodeCount = 0        
+        if useCache:
+            with self.timePhase('cacheLoad'):
+                cacheHit = self.loadCache(lazy)
+            if cacheHit:
+                self.storeBindPoses()
+                return
 
-        ##############################################
-        # Read MOTION into a numpy array
-        findFRAMEStart = 0 # just a little pointer to where the FRAME/animation data starts
-        for motionIter in range(numLines-1):
-            line = self.allLines[motionIter].split()
-            
-            if(line[0]=='MOTION'): 
-                findFRAMEStart = motionIter
+        with self.timePhase('parse'), open(bvhFileName) as bvhFile:
             
-        # Read MOTION header information
-        motionIter = findFRAMEStart
-        motionIter += 1
+            ##############################################
+            # Scan the HIERARCHY once, stopping at the MOTION line
+            self.readHierarchyLines(bvhFile)
             
-        line = self.allLines[motionIter].split()
-        motionIter += 1
-        self.totalFrames = int(line[1])
-           
-        line = self.allLines[motionIter].split()
-        motionIter += 1
-        self.frameTime = float(line[2])
-        motionIter += 1
-    
-        # Initialise a np array of zeros for the motion data so we can slice it 
-        # nicely later when reading the hierarchy and add it to each node on the fly
-        self.allMotion = np.zeros((self.totalFrames,len(self.allLines[motionIter].split())))
-        print('Shape of MOTION', np.shape(self.allMotion))
-        counter = 0
-    
-        while(motionIter < numLines-1):
-            line = self.allLines[motionIter].split()    
-            self.allMotion[counter,:] = line # stack the lines nicely into the array
-            motionIter += 1
-            counter += 1
+            ##############################################
+            # Read MOTION into a numpy array
+            self.readMotion(bvhFile, len(self.allLines))
         
+        logger.info('Shape of MOTION %s', np.shape(self.allMotion))
+
+        # Every frame row must hold one value per channel declared in the HIERARCHY
+        numChannels = self.countChannels()
+        if self.totalFrames > 0 and self.allMotion.shape[1] != numChannels:
+            raise ValueError('HIERARCHY declares {} channels but MOTION rows have {} values'
+                             .format(numChannels, self.allMotion.shape[1]))
+        if self.totalFrames == 0:
+            self.allMotion = np.zeros((0, numChannels))
+
         #############################################
         # Read HIERARCHY into a Node hierarchy
+        with self.timePhase('hierarchy'):
+            self.readHierarchy()
+        
+        #############################################
+        # Evaluate the transforms. Joints are numbered in the order they appear in the
+        # file (same order as bindTfrms) and all frames of a joint are done in one batch
+        self.lazy = lazy
+        self.clearPoseCache()
+        if self.lazy:
+            self.globalTransMats = np.zeros((0, self.totalJoints, 4, 4), dtype=self.dtype)
+            self.jointPositions = np.zeros((0, self.totalJoints, 3), dtype=self.dtype)
+        else:
+            self.computeAllPoses()
+        
+        self.storeBindPoses()
+        
+        if useCache:
+            with self.timePhase('cacheSave'):
+                self.saveCache()
+        
+        #return rootNode
+        
+            
+    def bvhStream(self, bvhFileName, chunkSize=1024):
+        
+        '''
+        # Generator for BVH files too large to hold in memory. The HIERARCHY is read once
+        # into the Node hierarchy as in bvhRead, then the MOTION block is read chunkSize
+        # frames at a time, yielding for each chunk:
+        #
+        #   (startFrame, motion, transMats, jointCoords)
+        #
+        #   startFrame  - index of the first frame in the chunk
+        #   motion      - (frames, channels) raw channel values
+        #   transMats   - (frames, joints, 4, 4) global transforms
+        #   jointCoords - (frames, joints, 3) global joint coordinates
+        #
+        # Memory use depends on chunkSize only, not the length of the file. While streaming,
+        # allMotion (and each Node's animation) holds the current chunk. The arrays yielded
+        # are not reused, so they can be kept or passed on to other workers.
+        '''
+        logger.info('Streaming BVH File.. %s', bvhFileName)
+        
+        self.fileName = bvhFileName
+        self.resetStats()
+        self.dirtyRanges = []
+        
+        with open(bvhFileName) as bvhFile:
+            self.readHierarchyLines(bvhFile)
+            lineNumber = self.readMotionHeader(bvhFile, len(self.allLines))
+            numChannels = self.countChannels()
+            
+            self.allMotion = np.zeros((0, numChannels))
+            with self.timePhase('hierarchy'):
+                self.readHierarchy()
+            self.lazy = False
+            self.clearPoseCache()
+            self.globalTransMats = np.zeros((0, self.totalJoints, 4, 4), dtype=self.dtype)
+            self.jointPositions = np.zeros((0, self.totalJoints, 3), dtype=self.dtype)
+            
+            startFrame = 0
+            while True:
+                lines = list(itertools.islice(bvhFile, chunkSize))
+                if not lines:
+                    break
+                
+                try:
+                    with self.timePhase('parse'), warnings.catch_warnings():
+                        warnings.simplefilter('ignore') # loadtxt warns on a chunk of blank lines
+                        motion = np.loadtxt(lines, dtype=np.float64, ndmin=2)
+                except ValueError:
+                    self.checkMotionRows(lines, lineNumber, numChannels)
+                    raise
+                lineNumber += len(lines)
+                self.counters['linesParsed'] += len(lines)
+                
+                if motion.shape[0] == 0:
+                    continue
+                if motion.shape[1] != numChannels:
+                    self.checkMotionRows(lines, lineNumber - len(lines), numChannels)
+                
+                self.setMotion(motion)
+                transMats = self.computeTransMats()
+                yield startFrame, motion, transMats, np.ascontiguousarray(transMats[:,:,0:3,3])
+                startFrame += motion.shape[0]
+        
+        if startFrame != self.totalFrames:
+            raise ValueError('MOTION header says {} frames but {} frame rows were found'
+                             .format(self.totalFrames, startFrame))
+
+    def setMotion(self, allMotion):
+        
+        # Replace allMotion and re-slice every Node's animation from it (if the Nodes have
+        # been made). Any poses computed from the old motion are dropped from the pose cache
+        self.allMotion = allMotion
+        if self.jointNodes:
+            for node, channelSlice in zip(self.jointNodes, self.channelSlices):
+                node.animation = self.allMotion[:,channelSlice]
+        self.clearPoseCache()
+
+    def bvhWrite(self, bvhFile, start=0, stop=None, step=1, precision=None, chunkSize=4096):
+        
+        '''
+        # Write the Node hierarchy and allMotion (or a frame range of it) as a BVH file.
+        #
+        #   bvhFile    - file name, or an open text file/stream to write to
+        #   start, stop, step - frames to write (as allMotion[start:stop:step]). With a step
+        #                the Frame Time is scaled to match
+        #   precision  - None (default) writes the shortest text that reads back as exactly
+        #                the same value. An int writes that many decimal places (lossy)
+        #   chunkSize  - frames formatted at a time. The frame block is formatted a chunk at
+        #                a time with a single string operation, so memory use does not grow
+        #                with the length of the clip
+        '''
+        if isinstance(bvhFile, str):
+            logger.info('Writing BVH File.. %s', bvhFile)
+            with open(bvhFile, 'w') as openFile:
+                return self.bvhWrite(openFile, start, stop, step, precision, chunkSize)
+        
+        frames = range(self.totalFrames)[start:stop:step]
+        
+        # HIERARCHY - the joints in joint (depth first) order, collecting each joint's channel
+        # columns so the MOTION columns are written in the same order as the joints
+        skeleton = self.skeleton
+        lines = ['HIERARCHY']
+        columns = []
+        depths = list(self.jointDepths) + [0]
+        for jointIndex, name in enumerate(skeleton.names):
+            depth = depths[jointIndex]
+            indent = '  ' * depth
+            isEndSite = name == 'End Site' and self.subtreeStops[jointIndex] == jointIndex + 1 # no children
+            if jointIndex == 0:
+                lines.append('ROOT ' + name)
+            elif isEndSite:
+                lines.append(indent + 'End Site')
+            else:
+                lines.append(indent + 'JOINT ' + name)
+            lines.append(indent + '{')
+            lines.append(indent + '  OFFSET ' + ' '.join([repr(float(value)) for value in skeleton.offsets[jointIndex]]))
+            if not isEndSite:
+                jointChannels = skeleton.channelNames[jointIndex]
+                lines.append(indent + '  CHANNELS {} '.format(len(jointChannels)) + ' '.join(jointChannels))
+            columns += range(self.channelSlices[jointIndex].start, self.channelSlices[jointIndex].stop)
+            
+            # Close the braces of this joint and of every ancestor whose subtree ends here
+            for closeDepth in range(depth, depths[jointIndex + 1] - 1, -1):
+                lines.append('  ' * closeDepth + '}')
+        
+        lines += ['MOTION', 'Frames: {}'.format(len(frames)), 'Frame Time: {!r}'.format(float(self.frameTime * abs(frames.step)))]
+        bvhFile.write('\n'.join(lines) + '\n')
+        
+        # MOTION - formatted a chunk of frames at a time
+        reorder = columns != list(range(len(columns)))
+        for chunkStart in range(0, len(frames), chunkSize):
+            chunk = np.asarray(self.allMotion[frames[chunkStart:chunkStart + chunkSize]], dtype=np.float64)
+            if reorder:
+                chunk = chunk[:,columns]
+            bvhFile.write(self.formatFrames(chunk, precision))
+
+    def formatFrames(self, frames, precision=None):
+        
+        # Format a (frames, channels) block as BVH frame rows in one go. With no precision
+        # each value is written as its shortest exact repr (reads back identically), by
+        # formatting the whole block as a nested list and turning that into rows
+        if frames.shape[0] == 0:
+            return ''
+        
+        if precision is not None:
+            rowFormat = ' '.join(['%.{}f'.format(precision)] * frames.shape[1]) + '\n'
+            return (rowFormat * frames.shape[0]) % tuple(frames.ravel())
+        
+        return repr(frames.tolist())[2:-2].replace('], [', '\n').replace(', ', ' ') + '\n'
+
+    def storeBindPoses(self):
+        
+        # Store the inverse bind pose for each node (in joint order) as a (joints,4,4) array
+        self.bindTfrms = []
+        if 0 <= self.bindPoseFrame < self.totalFrames:
+            with self.timePhase('bindPose'):
+                self.bindTfrms = self.invertRigidTransMats(self.getPose(self.bindPoseFrame))
+
+    def getCachePath(self):
+        
+        # Directory holding the cache entry for the current file
+        if self.cacheDir is None:
+            return self.fileName + '.cache'
+        
+        pathHash = hashlib.sha1(os.path.abspath(self.fileName).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cacheDir, os.path.basename(self.fileName) + '-' + pathHash)
+
+    def getCacheKey(self):
+        
+        # Identify the current version of the source file - a cache entry is only used
+        # if its key matches
+        stat = os.stat(self.fileName)
+        cacheKey = {'path': os.path.abspath(self.fileName), 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': None}
+        
+        if self.cacheHashContents:
+            fileHash = hashlib.sha1()
+            with open(self.fileName, 'rb') as bvhFile:
+                for block in iter(lambda: bvhFile.read(1 << 20), b''):
+                    fileHash.update(block)
+            cacheKey['hash'] = fileHash.hexdigest()
+        
+        return cacheKey
+
+    def writeCacheFile(self, cachePath, name, writeFunc):
+        
+        # Write a cache file to a temporary name then rename it into place, so readers
+        # (possibly in other processes) never see a partly written file
+        tempName = os.path.join(cachePath, '{}.{}.tmp'.format(name, os.getpid()))
+        with open(tempName, 'wb') as cacheFile:
+            writeFunc(cacheFile)
+        os.replace(tempName, os.path.join(cachePath, name))
+
+    def saveCache(self, posesOnly=False):
+        
+        # Write the hierarchy, raw motion and (if computed) the poses to the cache entry.
+        # meta.json is written last, so an entry is only valid once it is complete.
+        # A cache that can't be written (e.g. read only directory) is not an error
+        cachePath = self.getCachePath()
+        self.updatePoses()
+        
+        # Joints in index order with the index of their parent (-1 for the root)
+        meta = {'version': CACHE_VERSION,
+                'source': self.getCacheKey(),
+                'totalFrames': self.totalFrames,
+                'frameTime': self.frameTime,
+                'names': list(self.skeleton.names),
+                'offsets': self.skeleton.offsets.tolist(),
+                'channelNames': [list(jointChannels) for jointChannels in self.skeleton.channelNames],
+                'parents': self.getJointParents(),
+                'poses': not self.lazy,
+                'dtype': np.dtype(self.dtype).name}
+        
+        try:
+            os.makedirs(cachePath, exist_ok=True)
+            if not posesOnly:
+                self.writeCacheFile(cachePath, 'motion.npy', lambda f: np.save(f, self.allMotion))
+            if not self.lazy:
+                self.writeCacheFile(cachePath, 'globalTransMats.npy', lambda f: np.save(f, self.globalTransMats))
+                self.writeCacheFile(cachePath, 'jointPositions.npy', lambda f: np.save(f, self.jointPositions))
+            self.writeCacheFile(cachePath, 'meta.json', lambda f: f.write(json.dumps(meta).encode('utf-8')))
+        except OSError as error:
+            warnings.warn('Could not write BVH cache {}: {}'.format(cachePath, error))
+
+    def loadCache(self, lazy=False):
+        
+        # Load the current file from its cache entry. Returns False (and leaves this object
+        # untouched) if there is no entry or it is stale. The arrays are memory-mapped
+        # copy-on-write, so nothing is read until it is touched, the pages are shared
+        # between processes, and edits stay private to this object.
+        cachePath = self.getCachePath()
+        try:
+            with open(os.path.join(cachePath, 'meta.json'), 'rb') as metaFile:
+                meta = json.loads(metaFile.read().decode('utf-8'))
+            if meta['version'] != CACHE_VERSION or meta['source'] != self.getCacheKey():
+                return False
+            allMotion = np.load(os.path.join(cachePath, 'motion.npy'), mmap_mode='c')
+        except (OSError, ValueError, KeyError):
+            return False
+        
+        logger.info('Reading BVH cache.. %s', cachePath)
+        self.totalFrames = meta['totalFrames']
+        self.frameTime = meta['frameTime']
+        self.counters['frames'] = self.totalFrames
+        self.allMotion = allMotion
+        self.allLines = []
+        self.buildHierarchy(meta['names'], meta['offsets'], meta['channelNames'], meta['parents'])
+        
+        self.lazy = lazy
+        self.clearPoseCache()
+        poses = None
+        if not self.lazy and meta['poses'] and np.dtype(meta['dtype']).itemsize >= np.dtype(self.dtype).itemsize:
+            try:
+                globalTransMats = np.load(os.path.join(cachePath, 'globalTransMats.npy'), mmap_mode='c')
+                jointPositions = np.load(os.path.join(cachePath, 'jointPositions.npy'), mmap_mode='c')
+                if (globalTransMats.shape == (self.totalFrames, self.totalJoints, 4, 4) and
+                        jointPositions.shape == (self.totalFrames, self.totalJoints, 3)):
+                    poses = globalTransMats, jointPositions
+            except (OSError, ValueError):
+                pass
+            if poses is None:
+                logger.info('BVH cache poses missing or damaged, recomputing.. %s', cachePath)
+        
+        if self.lazy:
+            self.globalTransMats = np.zeros((0, self.totalJoints, 4, 4), dtype=self.dtype)
+            self.jointPositions = np.zeros((0, self.totalJoints, 3), dtype=self.dtype)
+        elif poses is not None:
+            self.globalTransMats, self.jointPositions = poses
+            if self.globalTransMats.dtype != self.dtype:
+                self.globalTransMats = self.globalTransMats.astype(self.dtype)
+                self.jointPositions = self.jointPositions.astype(self.dtype)
+        else:
+            # Entry was made by a lazy read, its poses are less precise than dtype (casting
+            # them up would not bring the precision back), or its pose files are missing or
+            # damaged - compute the poses now and add them to it
+            self.computeAllPoses()
+            self.saveCache(posesOnly=True)
+        
+        return True
+
+    def buildHierarchy(self, names, offsets, channelNames, parents):
+        
+        # Set up the skeleton from flat per joint lists (joints in file order, so a parent
+        # always comes before its children). The Skeleton comes from the template cache if
+        # a clip with the same joints has been read, and the Nodes are made when first used
+        self.nodeStack = []
+        self.bindTfrms = []
+        self.resetTopology()
+        self.setSkeleton(getSkeleton(names, offsets, channelNames, parents))
+
+    def resetStats(self):
+        
+        # Clear the instrumentation. timings holds seconds per phase (parse, hierarchy, fk,
+        # bindPose, cacheLoad, cacheSave, resample, update, render) and counters the work
+        # done by the last read:
+        #   linesParsed - lines of text parsed (HIERARCHY, MOTION header and frame rows)
+        #   joints, channels, frames - size of the clip
+        #   fkFrames - frames evaluated by forward kinematics (all joints each)
+        #   matmuls - 4x4 parent x local products done by forward kinematics
+        #   poseCacheHits, poseCacheMisses - frame block lookups in lazy mode
+        #   updatedJointFrames - joint x frame transforms recomputed by updatePoses after edits
+        #   templateHits - HIERARCHY blocks not parsed as their skeleton was in the template cache
+        self.timings = collections.OrderedDict()
+        self.counters = collections.OrderedDict([(name, 0) for name in
+            ['linesParsed', 'joints', 'channels', 'frames', 'fkFrames', 'matmuls', 'poseCacheHits', 'poseCacheMisses',
+             'updatedJointFrames', 'templateHits']])
+
+    @contextlib.contextmanager
+    def timePhase(self, phaseName):
+        
+        # Time a phase, adding it to timings and reporting it to the profiler hook and
+        # stats callback if they are set
+        profilerContext = contextlib.nullcontext()
+        if self.profilerHook is not None:
+            profilerContext = self.profilerHook(phaseName)
+        
+        start = time.perf_counter()
+        with profilerContext:
+            yield
+        seconds = time.perf_counter() - start
+        
+        self.timings[phaseName] = self.timings.get(phaseName, 0.0) + seconds
+        logger.debug('%s took %.4fs', phaseName, seconds)
+        if self.statsCallback is not None:
+            self.statsCallback(self, phaseName, seconds)
+
+    def readHierarchyLines(self, bvhFile):
+        
+        # Read lines from an open BVH file up to and including the MOTION line into allLines.
+        # Only the HIERARCHY is kept as strings - the frame block is never held as lines
+        self.allLines = []
+        line = bvhFile.readline()
+        while line:
+            self.allLines.append(line.rstrip('\r\n'))
+            words = line.split()
+            if words and words[0] == 'MOTION':
+                return
+            line = bvhFile.readline()
+        
+        raise ValueError('No MOTION section found in ' + self.fileName)
+
+    def countChannels(self):
+        
+        # Total number of channels declared in the HIERARCHY, i.e. the width of a frame row
+        skeleton = findHierarchyTemplate(self.allLines)
+        if skeleton is not None:
+            return skeleton.numChannels
+        return sum([int(words[1]) for words in [l.split() for l in self.allLines] if words[:1] == ['CHANNELS']])
+
+    def readHierarchy(self):
+        
+        # Build the Node hierarchy from the HIERARCHY lines in allLines, slicing each
+        # Node's animation out of allMotion as we go.
         # Push (append) JOINTS (and End Site) to a stack. When you see a }, then Pop joints off.
         # Always add a new Node as a child to whatever is currently top of the stack.
+        nodeCount = 0        
+        debug = logger.isEnabledFor(logging.DEBUG) # skip building messages nobody will see
+        self.nodeStack = []
+        self.channelTicker = 0
+        self.totalJoints = 0
+        self.bindTfrms = []
+        self.resetTopology()
+        
+        # A HIERARCHY read before in this process is not parsed again - the clip shares the
+        # Skeleton made then, and its Nodes are only made if they are used
+        skeleton = findHierarchyTemplate(self.allLines)
+        if skeleton is not None:
+            self.setSkeleton(skeleton)
+            self.counters['templateHits'] += 1
+            return
         
         # Get current line and split into 'words'
         self.lineIter = 0 
@@ -143,7 +811,8 @@ class BVHData:
         
             if line[0] == "ROOT":
                 nodeCount += 1
-                print('ROOT', self.lineIter, 'Count', nodeCount)
+                if debug:
+                    logger.debug('ROOT %d Count %d', self.lineIter, nodeCount)
                 # Get root data
                 rootNode = Node()
                 self.nodeStack.append(rootNode) # Push to top of stack
@@ -164,28 +833,13 @@ class BVHData:
                 rootNode.animation = self.allMotion[:,self.channelTicker:self.channelTicker + rootNode.numChannels]
                 rootNode.channelIndices = [self.channelTicker, self.channelTicker + rootNode.numChannels]
                 self.channelTicker += rootNode.numChannels
-                                 
-                
-                # Make transformation matrix for this node
-                for frame in range(self.totalFrames):
-                    
-                    rootNode.transMats.append(self.makeTransMat(rootNode.animation[frame,3:], rootNode.animation[frame,0:3], rootNode.channelNames))                                                            
-                    thisMat = rootNode.transMats[frame]
-                    rootNode.jointCoords.append([thisMat[0,3],thisMat[1,3],thisMat[2,3]])
-                    
-                    # Store the bind pose for this node
-                    if frame == self.bindPoseFrame:
-                        self.bindTfrms.append(np.linalg.inv(rootNode.transMats[frame]))
-                        
-            
-                # Associate this with main root of the BVH class
-                self.root = rootNode
-                self.totalJoints += 1
+                self.registerNode(rootNode) # the first joint is the root of the BVH class
                 # End root data - ok, so JOINT's start next
             
             if line[0] == "JOINT":
                 nodeCount += 1
-                print('JOINT', line[1], 'Line', self.lineIter, 'Count', nodeCount)
+                if debug:
+                    logger.debug('JOINT %s Line %d Count %d', line[1], self.lineIter, nodeCount)
                 # Create a joint and add it to the top of the stack.
                 # Increment global lineIter as we go so we are 
                 # in the right place in the BVH file all the time for any call
@@ -195,7 +849,8 @@ class BVHData:
                 
                 # Create an end node
                 nodeCount += 1
-                print('JOINT (End Site)', self.lineIter, 'Count', nodeCount)
+                if debug:
+                    logger.debug('JOINT (End Site) %d Count %d', self.lineIter, nodeCount)
                 self.nodeStack.append(self.addEndSite())
         
             if line[0] == "}":
@@ -203,17 +858,81 @@ class BVHData:
                 if(self.nodeStack):
                     # Pop the stack, so that new children are added to the correct node
                     nodeCount -= 1
-                    print('Pop Joint - Count', nodeCount)
+                    if debug:
+                        logger.debug('Pop Joint - Count %d', nodeCount)
                     self.nodeStack.pop()
                 else:
-                    print('Stack empty')
-                    print(self.nodeStack)
+                    logger.warning('Unmatched } on line %d - stack empty', self.lineIter + 1)
     
             self.lineIter += 1
         
-        #return rootNode
+        self.buildTopology()
+        addHierarchyTemplate(self.allLines, self.skeleton)
+
+    def readMotionHeader(self, bvhFile, lineNumber):
         
-            
+        # Read the Frames: and Frame Time: lines following the MOTION line (line number
+        # lineNumber, 1 based). Returns the line number of the first frame row.
+        line = bvhFile.readline().split()
+        self.totalFrames = int(line[1])
+        self.counters['frames'] = self.totalFrames
+        
+        line = bvhFile.readline().split()
+        self.frameTime = float(line[2])
+        
+        return lineNumber + 3
+
+    def readMotion(self, bvhFile, lineNumber):
+        
+        # Read the MOTION header and frame block from an open file positioned just after
+        # the MOTION line. lineNumber is the (1 based) line number of the MOTION line and
+        # is only used for error reporting.
+        firstFrameLine = self.readMotionHeader(bvhFile, lineNumber)
+        
+        # Parse the whole frame block in one go straight into a float array.
+        # If that fails, go back and find the offending rows so we can report them
+        frameStart = bvhFile.tell()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore') # loadtxt warns on an empty frame block
+                self.allMotion = np.loadtxt(bvhFile, dtype=np.float64, ndmin=2)
+        except ValueError:
+            bvhFile.seek(frameStart)
+            self.checkMotionRows(bvhFile, firstFrameLine)
+            raise
+        
+        self.counters['linesParsed'] += len(self.allLines) + 2 + self.allMotion.shape[0]
+        
+        if self.allMotion.shape[0] != self.totalFrames:
+            raise ValueError('MOTION header says {} frames but {} frame rows were found (frames start on line {})'
+                             .format(self.totalFrames, self.allMotion.shape[0], firstFrameLine))
+
+    def checkMotionRows(self, bvhFile, firstFrameLine, numColumns=None):
+        
+        # Slow path, only used when the bulk parse fails. Walk the frame block (an open file
+        # or any iterable of lines) line by line and raise a ValueError listing malformed
+        # (non numeric) or short/long rows. Rows are compared against numColumns, or the
+        # width of the first frame row if it is not given.
+        badRows = []
+        lineNumber = firstFrameLine
+        
+        for line in bvhFile:
+            words = line.split()
+            if words:
+                if numColumns is None:
+                    numColumns = len(words)
+                try:
+                    [float(word) for word in words]
+                    if len(words) != numColumns:
+                        badRows.append('line {}: expected {} values, found {}'.format(lineNumber, numColumns, len(words)))
+                except ValueError:
+                    badRows.append('line {}: non numeric value'.format(lineNumber))
+            lineNumber += 1
+        
+        if badRows:
+            raise ValueError('Malformed MOTION rows in {}:\n    '.format(self.fileName) + '\n    '.join(badRows[:20])
+                             + ('\n    ... and {} more'.format(len(badRows) - 20) if len(badRows) > 20 else ''))
+
     def addJoint(self):        
         
         # Read JOINT NAME, OFFSET, CHANNEL  and Animation for this joint
@@ -236,33 +955,10 @@ class BVHData:
         jointNode.animation = self.allMotion[:,self.channelTicker:self.channelTicker + jointNode.numChannels]
         jointNode.channelIndices = [self.channelTicker, self.channelTicker + jointNode.numChannels]
         self.channelTicker += jointNode.numChannels              
-    
-        
-        # Make transformation matrices for this node (mult by parent transMat)
-        for frame in range(self.totalFrames):
-            parentTrans = self.nodeStack[-1].transMats[frame]             
-            
-            if jointNode.numChannels==3:
-                # There is no additional translation of the bone, so just use offset for translation
-                jointNode.transMats.append(np.matmul(parentTrans,self.makeTransMat(jointNode.animation[frame,0:3], jointNode.offset, jointNode.channelNames)))                                      
-                
-            else:
-                # There is an additional translation of the bone, so just offset + the translation
-                #newTrans = [jointNode.offset[i] + jointNode.animation[frame][i] for i in range(len(jointNode.offset))]
-                temp = [0,0,0]
-                newTrans = [jointNode.offset[i] + temp[i] for i in range(len(jointNode.offset))]                            
-                jointNode.transMats.append(np.matmul(parentTrans,self.makeTransMat(jointNode.animation[frame,3:],newTrans, jointNode.channelNames)))                   
-            
-            # Store the bind pose for this node
-            if frame == self.bindPoseFrame:
-                self.bindTfrms.append(np.linalg.inv(jointNode.transMats[frame]))
-            
-            thisMat = jointNode.transMats[-1]
-            jointNode.jointCoords.append([thisMat[0,3],thisMat[1,3],thisMat[2,3]])             
         
         # Make this joint a child of whatever is top of the stack
         self.nodeStack[-1].childNodes.append(jointNode)    
-        self.totalJoints += 1
+        self.registerNode(jointNode, self.nodeStack[-1])
         
         return jointNode
 
@@ -282,23 +978,623 @@ class BVHData:
         endNode.channelIndices = [self.channelTicker, self.channelTicker + endNode.numChannels]
         self.channelTicker += endNode.numChannels 
     
-        # Make transformation matrices for this node (mult by parent transMat)
-        for frame in range(self.totalFrames):
-            parentTrans = self.nodeStack[-1].transMats[frame]             
-            endNode.transMats.append(np.matmul(parentTrans,self.makeTransMat([0,0,0], endNode.offset, self.root.channelNames)))            
-            thisMat = endNode.transMats[-1]
-            endNode.jointCoords.append([thisMat[0,3],thisMat[1,3],thisMat[2,3]]) 
-            
-            # Store the bind pose for this node
-            if frame == self.bindPoseFrame:
-                self.bindTfrms.append(np.linalg.inv(endNode.transMats[frame]))
-    
         # Make this joint a child of whatever is top of the stack
         self.nodeStack[-1].childNodes.append(endNode)    
-        self.totalJoints += 1
+        self.registerNode(endNode, self.nodeStack[-1])
     
         return endNode
 
+    def registerNode(self, node, parent=None):
+        
+        # Give a new Node the next joint slot in the BVHData pose arrays and add it to the
+        # flat topology (parent is its parent Node, None for the root)
+        node.jointIndex = self.totalJoints
+        node.bvhData = self
+        self.totalJoints += 1
+        self.jointNodes.append(node)
+        self.jointParents.append(-1 if parent is None else parent.jointIndex)
+
+    def resetTopology(self):
+        
+        # Empty topology, filled in by registerNode and buildTopology (or setSkeleton)
+        self.skeleton = None # the shared, read-only Skeleton of this clip (see setSkeleton)
+        self.jointNodes = [] # the Node of every joint, None until first used (see joints)
+        self.jointParents = [] # parent joint index of every joint (-1 for the root)
+        self.jointIndexByName = {} # joint name to index (the first joint of that name, e.g. 'End Site')
+        self.channelSlices = [] # allMotion column slice of every joint's channels
+        self.jointDepths = np.zeros(0, dtype=np.intp) # depth in the hierarchy (root is 0)
+        self.jointLevels = [] # joint indices at each depth - jointLevels[depth]
+        self.subtreeStops = np.zeros(0, dtype=np.intp) # a joint's subtree is joints[i:subtreeStops[i]]
+        self.jointOffsets = np.zeros((0,3)) # (joints,3) OFFSETs
+        self.rotationGroups = {} # see getRotationGroups
+        self.positionJoints = np.zeros(0, dtype=np.intp) # joints with X/Y/Z position channels
+        self.positionColumns = np.zeros((0,3), dtype=np.intp) # their allMotion columns
+
+    def buildTopology(self):
+        
+        # Turn the joints registered while reading the HIERARCHY into their Skeleton, taken
+        # from the template cache if another clip has the same joints
+        nodes = self.jointNodes
+        skeleton = getSkeleton([node.name for node in nodes], [node.offset for node in nodes],
+                               [node.channelNames for node in nodes], self.jointParents)
+        self.setSkeleton(skeleton, nodes)
+
+    def setSkeleton(self, skeleton, nodes=None):
+        
+        # Use a (shared) Skeleton for this clip. The flat topology attributes are its read-only
+        # arrays. nodes is the Node of every joint if they have been made already - if not,
+        # they are only made if the Node hierarchy is used (see joints)
+        self.skeleton = skeleton
+        self.jointNodes = nodes
+        self.totalJoints = skeleton.numJoints
+        self.channelTicker = skeleton.numChannels
+        self.jointParents = skeleton.parents
+        self.jointIndexByName = skeleton.jointIndexByName
+        self.channelSlices = skeleton.channelSlices
+        self.jointOffsets = skeleton.offsets
+        self.jointDepths = skeleton.depths
+        self.jointLevels = skeleton.levels
+        self.subtreeStops = skeleton.subtreeStops
+        self.rotationGroups = skeleton.rotationGroups
+        self.positionJoints = skeleton.positionJoints
+        self.positionColumns = skeleton.positionColumns
+        self.counters['joints'] = self.totalJoints
+        self.counters['channels'] = self.channelTicker
+
+    def __getstate__(self):
+        
+        # Pickle (and deepcopy) without the skeleton's read-only dict views, which can't be
+        # pickled - __setstate__ takes them from the unpickled Skeleton again
+        state = self.__dict__.copy()
+        state['jointIndexByName'] = {}
+        state['rotationGroups'] = {}
+        return state
+
+    def __setstate__(self, state):
+        
+        self.__dict__.update(state)
+        if self.skeleton is not None:
+            self.jointIndexByName = self.skeleton.jointIndexByName
+            self.rotationGroups = self.skeleton.rotationGroups
+
+    def buildNodes(self):
+        
+        # Make the Node hierarchy from the skeleton, slicing each Node's animation out of allMotion
+        skeleton = self.skeleton
+        nodes = []
+        for jointIndex, parent in enumerate(skeleton.parents.tolist()):
+            node = Node()
+            node.name = skeleton.names[jointIndex]
+            node.offset = skeleton.offsets[jointIndex].tolist()
+            node.channelNames = list(skeleton.channelNames[jointIndex])
+            node.numChannels = len(node.channelNames)
+            channelSlice = skeleton.channelSlices[jointIndex]
+            node.channelIndices = [channelSlice.start, channelSlice.stop]
+            node.animation = self.allMotion[:,channelSlice]
+            node.jointIndex = jointIndex
+            node.bvhData = self
+            if parent >= 0:
+                nodes[parent].childNodes.append(node)
+            nodes.append(node)
+        
+        self.jointNodes = nodes
+
+    @property
+    def joints(self):
+        
+        # Every Node in joint order - file order, so parents come before children. Clips
+        # using a skeleton template only make their Nodes when this is first used
+        if self.jointNodes is None:
+            self.buildNodes()
+        return self.jointNodes
+
+    @property
+    def root(self):
+        
+        # The root Node (an empty Node if no HIERARCHY has been read)
+        joints = self.joints
+        return joints[0] if joints else Node()
+
+    def computeTransMats(self, frames=slice(None), workers=None, chunkSize=None):
+        
+        # Forward kinematics for the whole skeleton over a set of frames (a slice or an
+        # array of frame indices into allMotion). Returns (frames, joints, 4, 4) global transforms.
+        # workers/chunkSize override fkWorkers/fkChunkSize (see computeSubtreeTransMats)
+        with self.timePhase('fk'):
+            numFrames = self.allMotion[frames].shape[0]
+            transMats = np.zeros((numFrames, self.totalJoints, 4, 4), dtype=self.dtype)
+            self.computeSubtreeTransMats(0, None, frames, transMats, workers, chunkSize)
+            self.counters['fkFrames'] += numFrames
+            self.counters['matmuls'] += numFrames * max(self.totalJoints - 1, 0)
+        
+        return transMats
+
+    def computeSubtreeTransMats(self, joint, parentMats, frames, transMats, workers=None, chunkSize=None):
+        
+        # Forward kinematics for a joint (Node, name or index) and everything below it over a
+        # set of frames, written into the matching frames of transMats (frames, joints, 4, 4).
+        # parentMats is the (frames,4,4) global transforms of the joint's parent (None for the root).
+        # Returns the joint indices of the subtree.
+        #
+        # Frames are evaluated in chunks of chunkSize (default fkChunkSize), which bounds the
+        # working memory. With more than one worker (default fkWorkers) the chunks run
+        # concurrently in a thread pool - frames are independent, and NumPy releases the GIL
+        # in its array loops. Each chunk writes its own rows of transMats, so no copying or
+        # locking is needed
+        workers = self.fkWorkers if workers is None else workers
+        chunkSize = self.fkChunkSize if chunkSize is None else chunkSize
+        jointIndex = self.getJointIndex(joint)
+        
+        allFrames = range(self.allMotion.shape[0])
+        frameList = allFrames[frames] if isinstance(frames, slice) else np.asarray(frames)
+        numFrames = len(frameList)
+        
+        chunks = []
+        for chunkStart in range(0, max(numFrames, 1), chunkSize):
+            rows = slice(chunkStart, min(chunkStart + chunkSize, numFrames))
+            chunkFrames = frameList[rows]
+            if isinstance(chunkFrames, range):
+                if chunkFrames.step > 0:
+                    chunkFrames = slice(chunkFrames.start, chunkFrames.stop, chunkFrames.step)
+                else:
+                    chunkFrames = np.asarray(chunkFrames)
+            chunkParentMats = None if parentMats is None else parentMats[rows]
+            chunks.append((jointIndex, chunkParentMats, chunkFrames, transMats[rows]))
+        
+        if workers <= 1 or len(chunks) == 1:
+            subtrees = [self.evaluateSubtree(*chunk) for chunk in chunks]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                subtrees = list(pool.map(lambda chunk: self.evaluateSubtree(*chunk), chunks))
+        
+        return subtrees[0]
+
+    def evaluateSubtree(self, jointIndex, parentMats, frames, transMats):
+        
+        # The serial part of computeSubtreeTransMats. The subtree is the joint range
+        # jointIndex:subtreeStops[jointIndex]. Local transforms of all its joints are built in
+        # a batch per rotation order, then the hierarchy is walked level by level - one
+        # (frames, joints at this level) parent x local product per level
+        jointStop = self.subtreeStops[jointIndex]
+        localMats = self.makeJointLocalTransMats(frames, jointIndex, jointStop)
+        parents = self.jointParents[jointIndex:jointStop] - jointIndex
+        
+        # Accumulate in float64 whatever the storage dtype
+        globalMats = np.empty_like(localMats)
+        if parentMats is None:
+            # The root position channels give the absolute root translation
+            globalMats[:,0] = localMats[:,0]
+        else:
+            globalMats[:,0] = np.matmul(parentMats, localMats[:,0])
+        
+        for levelJoints in self.jointLevels[self.jointDepths[jointIndex] + 1:]:
+            if jointStop - jointIndex < self.totalJoints:
+                levelJoints = levelJoints[(levelJoints > jointIndex) & (levelJoints < jointStop)]
+            if len(levelJoints) == 0:
+                break
+            levelJoints = levelJoints - jointIndex
+            
+            # (F,L,4,4) parent transforms times (F,L,4,4) local transforms
+            globalMats[:,levelJoints] = np.matmul(globalMats[:,parents[levelJoints]], localMats[:,levelJoints])
+        
+        transMats[:,jointIndex:jointStop] = globalMats
+        
+        return np.arange(jointIndex, jointStop)
+
+    def makeJointLocalTransMats(self, frames, jointStart=0, jointStop=None):
+        
+        # Local (frames, joints, 4, 4) transforms of the joints jointStart:jointStop over a set
+        # of frames, with the rotations of all joints sharing a rotation order made in one batch.
+        # Root position channels are the absolute root translation. Any other joint with
+        # position channels is translated by offset + translation
+        jointStop = self.totalJoints if jointStop is None else jointStop
+        animation = self.allMotion[frames]
+        
+        localMats = np.zeros((animation.shape[0], jointStop - jointStart, 4, 4))
+        localMats[...,0:3,0:3] = np.eye(3)
+        localMats[...,0:3,3] = self.jointOffsets[jointStart:jointStop]
+        localMats[...,3,3] = 1
+        
+        wholeSkeleton = jointStart == 0 and jointStop == self.totalJoints
+        for rotOrder, (jointIndices, columns) in self.rotationGroups.items():
+            if not rotOrder:
+                continue
+            if not wholeSkeleton:
+                inRange = (jointIndices >= jointStart) & (jointIndices < jointStop)
+                jointIndices, columns = jointIndices[inRange], columns[inRange]
+            if len(jointIndices):
+                localMats[:,jointIndices - jointStart,0:3,0:3] = self.makeRotMats(animation[:,columns], rotOrder)
+        
+        for jointIndex, columns in zip(self.positionJoints, self.positionColumns):
+            if jointStart <= jointIndex < jointStop:
+                if self.jointParents[jointIndex] < 0:
+                    localMats[:,jointIndex - jointStart,0:3,3] = animation[:,columns]
+                else:
+                    localMats[:,jointIndex - jointStart,0:3,3] += animation[:,columns]
+        
+        return localMats
+
+    def computeAllPoses(self, workers=None, chunkSize=None):
+        
+        # Evaluate every frame into globalTransMats/jointPositions. For a lazily read
+        # file this switches over to the fully evaluated arrays.
+        # workers/chunkSize override fkWorkers/fkChunkSize (see computeSubtreeTransMats)
+        self.globalTransMats = self.computeTransMats(slice(None), workers, chunkSize)
+        self.jointPositions = np.ascontiguousarray(self.globalTransMats[:,:,0:3,3])
+        self.lazy = False
+        self.dirtyRanges = []
+        self.clearPoseCache()
+
+    def getJointIndex(self, joint):
+        
+        # Joint index of a Node, a joint name (the first joint of that name) or an index
+        if isinstance(joint, Node):
+            return joint.jointIndex
+        if isinstance(joint, str):
+            if joint not in self.jointIndexByName:
+                raise KeyError('No joint named {!r}'.format(joint))
+            return self.jointIndexByName[joint]
+        if not -self.totalJoints <= joint < self.totalJoints:
+            raise IndexError('joint {} out of range for {} joints'.format(joint, self.totalJoints))
+        return joint % self.totalJoints
+
+    def markDirty(self, joint, start=0, stop=None):
+        
+        # Mark frames start:stop of a joint (Node, name or index) as edited, e.g. after
+        # changing its Node.animation or allMotion columns directly. The joint and everything
+        # below it are recomputed for those frames by the next updatePoses (called for you
+        # by getPose, getPoses, Node.transMats and Node.jointCoords)
+        frames = range(self.totalFrames)[start:stop]
+        if len(frames):
+            self.dirtyRanges.append((self.getJointIndex(joint), frames.start, frames.stop))
+
+    def editChannels(self, joint, values, start=0, channelNames=None):
+        
+        # Write (frames, channels) values into a joint's channels from frame start and mark
+        # them dirty. channelNames picks the channels written (default: all of the joint's,
+        # in file order), e.g. editChannels('lFoot', angles, 100, ['Zrotation'])
+        jointIndex = self.getJointIndex(joint)
+        jointChannels = self.skeleton.channelNames[jointIndex]
+        if channelNames is None:
+            channelNames = jointChannels
+        columns = [self.channelSlices[jointIndex].start + jointChannels.index(name) for name in channelNames]
+        
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(columns))
+        stop = start + values.shape[0]
+        if not 0 <= start <= stop <= self.totalFrames:
+            raise IndexError('frames {}:{} out of range for {} frames'.format(start, stop, self.totalFrames))
+        
+        self.allMotion[start:stop, columns] = values
+        self.markDirty(jointIndex, start, stop)
+
+    def updatePoses(self):
+        
+        '''
+        # Bring the poses up to date with the edits marked by markDirty/editChannels.
+        #
+        # Only the dirty joints' subtrees are recomputed, and only over the dirty frames,
+        # starting from the stored global transforms of each joint's parent. Everything
+        # else in globalTransMats/jointPositions is left untouched. Edits of the same joint
+        # are merged, and a range already covered by an ancestor's recompute is skipped.
+        # In lazy mode the cached frame blocks overlapping the edits are dropped instead.
+        # The bind pose is refreshed if its frame was edited.
+        '''
+        if not self.dirtyRanges:
+            return
+        
+        with self.timePhase('update'):
+            # Merge overlapping ranges per joint. Joint order puts parents before children
+            merged = []
+            for jointIndex, start, stop in sorted(self.dirtyRanges):
+                if merged and merged[-1][0] == jointIndex and start <= merged[-1][2]:
+                    merged[-1][2] = max(merged[-1][2], stop)
+                else:
+                    merged.append([jointIndex, start, stop])
+            self.dirtyRanges = []
+            
+            if self.lazy:
+                for jointIndex, start, stop in merged:
+                    for block in range(start // self.poseBlockSize, (stop - 1) // self.poseBlockSize + 1):
+                        self.poseCache.pop(block, None)
+            else:
+                done = []
+                for jointIndex, start, stop in merged:
+                    # Joints are in depth first order, so the subtree of a joint done earlier is
+                    # the range doneJoint:subtreeStops[doneJoint]
+                    if any(doneJoint <= jointIndex < self.subtreeStops[doneJoint] and doneStart <= start and stop <= doneStop
+                           for doneJoint, doneStart, doneStop in done):
+                        continue
+                    
+                    parentMats = None
+                    parent = self.jointParents[jointIndex]
+                    if parent >= 0:
+                        parentMats = self.globalTransMats[start:stop, parent]
+                    subtree = self.computeSubtreeTransMats(jointIndex, parentMats, slice(start, stop),
+                                                           self.globalTransMats[start:stop])
+                    subtree = slice(subtree[0], subtree[-1] + 1)
+                    self.jointPositions[start:stop, subtree] = self.globalTransMats[start:stop, subtree, 0:3, 3]
+                    self.counters['updatedJointFrames'] += (subtree.stop - subtree.start) * (stop - start)
+                    self.counters['matmuls'] += (subtree.stop - subtree.start) * (stop - start)
+                    done.append((jointIndex, start, stop))
+            
+            if any(start <= self.bindPoseFrame < stop for jointIndex, start, stop in merged):
+                self.storeBindPoses()
+
+    def clearPoseCache(self):
+        
+        # Drop all cached frame blocks, e.g. after editing allMotion
+        self.poseCache = collections.OrderedDict()
+
+    def getPoseBlock(self, block):
+        
+        # Return the (poseBlockSize, joints, 4, 4) transforms of a block of frames, from the
+        # LRU cache if it has been evaluated recently
+        if block in self.poseCache:
+            self.poseCache.move_to_end(block)
+            self.counters['poseCacheHits'] += 1
+            return self.poseCache[block]
+        
+        self.counters['poseCacheMisses'] += 1
+        
+        start = block * self.poseBlockSize
+        transMats = self.computeTransMats(slice(start, min(start + self.poseBlockSize, self.totalFrames)))
+        transMats.flags.writeable = False
+        
+        self.poseCache[block] = transMats
+        while len(self.poseCache) > self.poseCacheBlocks:
+            self.poseCache.popitem(last=False)
+        
+        return transMats
+
+    def getPose(self, frame):
+        
+        # Global transforms of every joint for one frame - (joints, 4, 4).
+        # Joint coordinates are getPose(frame)[:,0:3,3]
+        if frame < 0:
+            frame += self.totalFrames
+        if not 0 <= frame < self.totalFrames:
+            raise IndexError('frame {} out of range for {} frames'.format(frame, self.totalFrames))
+        
+        self.updatePoses()
+        if not self.lazy:
+            return self.globalTransMats[frame]
+        
+        return self.getPoseBlock(frame // self.poseBlockSize)[frame % self.poseBlockSize]
+
+    def getPoses(self, start=0, stop=None, step=1):
+        
+        # Global transforms of every joint for frames start:stop:step - (frames, joints, 4, 4).
+        # Zero-copy when all poses have been computed. In lazy mode only the frame blocks
+        # covering the range are evaluated (and cached).
+        frames = range(self.totalFrames)[start:stop:step]
+        
+        self.updatePoses()
+        if not self.lazy:
+            return self.globalTransMats[start:stop:step]
+        
+        # Sparse sampling would evaluate a whole block per frame, so just do those frames
+        if abs(frames.step) >= self.poseBlockSize:
+            return self.computeTransMats(np.asarray(frames))
+        
+        transMats = np.zeros((len(frames), self.totalJoints, 4, 4), dtype=self.dtype)
+        frames = np.asarray(frames)
+        blocks = frames // self.poseBlockSize
+        for block in np.unique(blocks):
+            inBlock = blocks == block
+            transMats[inBlock] = self.getPoseBlock(block)[frames[inBlock] % self.poseBlockSize]
+        
+        return transMats
+
+    def getJointPoses(self, joint, start=0, stop=None):
+        
+        # Global transforms of one joint (Node, name or index) for frames start:stop -
+        # (frames, 4, 4). In lazy mode the frame blocks are evaluated (and cached) one at a
+        # time, so only this joint's transforms are held for the whole range
+        jointIndex = self.getJointIndex(joint)
+        frames = range(self.totalFrames)[start:stop]
+        
+        self.updatePoses()
+        if not self.lazy:
+            return self.globalTransMats[frames.start:frames.stop, jointIndex]
+        
+        transMats = np.zeros((len(frames), 4, 4), dtype=self.dtype)
+        for blockStart in range(frames.start - frames.start % self.poseBlockSize, frames.stop, self.poseBlockSize):
+            block = self.getPoseBlock(blockStart // self.poseBlockSize)
+            first, last = max(frames.start, blockStart), min(frames.stop, blockStart + self.poseBlockSize)
+            transMats[first - frames.start:last - frames.start] = block[first - blockStart:last - blockStart, jointIndex]
+        
+        return transMats
+
+    def getJointParents(self):
+        
+        # Index of the parent of every joint (-1 for the root), in joint order, as a list
+        # (jointParents is the same as an array)
+        return self.jointParents.tolist()
+
+    def getJoints(self):
+        
+        # Every Node in joint order (jointIndex)
+        return self.joints
+
+    def getJointNames(self):
+        
+        # Name of every joint in joint order (without making the Nodes)
+        return list(self.skeleton.names) if self.skeleton is not None else []
+
+    def getChannelNames(self):
+        
+        # 'joint:channel' name of every allMotion column, e.g. 'hip:Zrotation'
+        if self.skeleton is None:
+            return []
+        return [name + ':' + channelName for name, jointChannels in zip(self.skeleton.names, self.skeleton.channelNames)
+                for channelName in jointChannels]
+
+    def getRotationGroups(self):
+        
+        # Joints grouped by rotation order, so each group can be converted in one batch.
+        # Returns {rotOrder: (jointIndices, columns)} where columns is the (joints, len(rotOrder))
+        # array of the allMotion columns holding each joint's rotation channels. Built once
+        # per file by buildTopology
+        return self.rotationGroups
+
+    def getRotations(self, representation='quaternion', space='local', start=0, stop=None, step=1,
+                     dtype=None, continuous=True):
+        
+        '''
+        # Rotations of every joint for frames start:stop:step as a dense (frames, joints, D) array.
+        #
+        #   representation - 'quaternion' (w,x,y,z), 'matrix' (row major 3x3), '6d' (first two
+        #                    matrix columns) or 'axisAngle' (rotation vector in radians)
+        #   space          - 'local' rotations straight from the Euler channels (no FK needed,
+        #                    so a lazy clip is not evaluated) or 'global' from the FK transforms
+        #   dtype          - output precision, e.g. np.float32 (default: the clip's dtype)
+        #   continuous     - flip quaternion signs so neighbouring frames are in the same
+        #                    hemisphere (q and -q are the same rotation)
+        #
+        # Joints are converted in one batch per rotation order, so the cost does not grow
+        # with Python loops over frames or joints. Conversions are done in float64.
+        '''
+        if space not in ('local', 'global'):
+            raise ValueError("space must be 'local' or 'global', not {!r}".format(space))
+        if representation not in BVHRotations.REPRESENTATIONS:
+            raise ValueError('representation must be one of {}, not {!r}'.format(
+                sorted(BVHRotations.REPRESENTATIONS), representation))
+        
+        frames = np.arange(self.totalFrames)[start:stop:step]
+        
+        if space == 'local':
+            quats = np.zeros((len(frames), self.totalJoints, 4))
+            allMotion = np.asarray(self.allMotion, dtype=np.float64)
+            for rotOrder, (jointIndices, columns) in self.getRotationGroups().items():
+                quats[:,jointIndices] = BVHRotations.eulerToQuat(allMotion[frames[:,np.newaxis,np.newaxis], columns], rotOrder)
+        else:
+            rotMats = np.asarray(self.getPoses(start, stop, step)[...,0:3,0:3], dtype=np.float64)
+            if representation == 'matrix':
+                return rotMats.reshape(rotMats.shape[0:2] + (9,)).astype(dtype or self.dtype)
+            if representation == '6d':
+                return BVHRotations.matToSixD(rotMats).astype(dtype or self.dtype)
+            quats = BVHRotations.matToQuat(rotMats)
+        
+        return BVHRotations.toRepresentation(quats, representation, continuous).astype(dtype or self.dtype)
+
+    def resample(self, frameTime, method='fk'):
+        
+        '''
+        # Return a new BVHData clip at a different frame rate, e.g. resample(1.0/30) to get
+        # 30fps from a 120fps clip. The new clip covers the same time span: totalFrames is
+        # recomputed and frameTime set, and this object is left untouched.
+        #
+        # Frame n of the new clip sits at n * frameTime and is interpolated between the two
+        # source frames around it. Position channels are interpolated linearly. Joints with
+        # three rotation channels are interpolated by quaternion slerp in that joint's channel
+        # order, then turned back into Euler angles on the same branch as the source angles
+        # (other rotation channels are interpolated linearly). All of this is done for every
+        # frame and joint at once. Samples landing exactly on a source frame copy it.
+        #
+        #   method - 'fk' to run forward kinematics on just the resampled frames (a lazy
+        #            clip stays lazy), or 'transforms' to interpolate the global transforms
+        #            already computed (rotations by slerp, translations linearly) without FK
+        #
+        # The bind pose (bindTfrms) carries over unchanged.
+        '''
+        if method not in ('fk', 'transforms'):
+            raise ValueError("method must be 'fk' or 'transforms', not {!r}".format(method))
+        frameTime = float(frameTime) # a plain float (not a NumPy scalar) for bvhWrite and the cache meta
+        if not 0 < frameTime < math.inf or self.frameTime <= 0:
+            raise ValueError('frame times must be positive, got {} (source {})'.format(frameTime, self.frameTime))
+        
+        with self.timePhase('resample'):
+            # Source frame (and fraction of the way to the next) for every new frame
+            numFrames = 0
+            if self.totalFrames > 0:
+                numFrames = int(np.floor((self.totalFrames - 1) * self.frameTime / frameTime + 1e-9)) + 1
+            sampleTimes = np.arange(numFrames) * (frameTime / self.frameTime)
+            frames0 = np.minimum(np.floor(sampleTimes + 1e-9).astype(np.intp), max(self.totalFrames - 2, 0))
+            frames1 = np.minimum(frames0 + 1, max(self.totalFrames - 1, 0))
+            weights = np.clip(sampleTimes - frames0, 0, 1)
+            weights[np.abs(weights) < 1e-9] = 0
+            
+            resampled = BVHData(self.fileName, self.dtype)
+            resampled.fkWorkers = self.fkWorkers
+            resampled.fkChunkSize = self.fkChunkSize
+            resampled.totalFrames = numFrames
+            resampled.frameTime = frameTime
+            resampled.allMotion = self.resampleMotion(frames0, frames1, weights)
+            resampled.counters['frames'] = numFrames
+            
+            resampled.setSkeleton(self.skeleton) # same joints, so share the Skeleton
+            
+            # The bind pose frame index means nothing at the new rate, but the bind pose is the same
+            resampled.bindTfrms = np.array(self.bindTfrms, copy=True)
+            
+            if method == 'transforms':
+                resampled.globalTransMats = self.resampleTransMats(frames0, frames1, weights)
+                resampled.jointPositions = np.ascontiguousarray(resampled.globalTransMats[:,:,0:3,3])
+        
+        if method == 'fk':
+            resampled.lazy = self.lazy
+            if resampled.lazy:
+                resampled.globalTransMats = np.zeros((0, resampled.totalJoints, 4, 4), dtype=self.dtype)
+                resampled.jointPositions = np.zeros((0, resampled.totalJoints, 3), dtype=self.dtype)
+            else:
+                resampled.computeAllPoses()
+        
+        return resampled
+
+    def resampleMotion(self, frames0, frames1, weights):
+        
+        # Interpolate allMotion between rows frames0 and frames1 (weights 0 gives frames0,
+        # 1 gives frames1). Returns the new (frames, channels) motion
+        allMotion = np.asarray(self.allMotion, dtype=np.float64)
+        motion0 = allMotion[frames0]
+        
+        # Linear interpolation of every channel - kept for position channels and used as the
+        # reference branch for the slerped rotations
+        newMotion = motion0 + weights[:,np.newaxis] * (allMotion[frames1] - motion0)
+        
+        # Three axis rotations are converted one rotation order at a time, each in one
+        # batch of (frames, joints, 3). Rows landing exactly on a source frame keep their angles
+        rows = np.flatnonzero(weights > 0)
+        for rotOrder, (jointIndices, columns) in self.getRotationGroups().items():
+            if len(rotOrder) != 3:
+                continue
+            quats0 = BVHRotations.eulerToQuat(allMotion[frames0[rows,np.newaxis,np.newaxis], columns], rotOrder)
+            quats1 = BVHRotations.eulerToQuat(allMotion[frames1[rows,np.newaxis,np.newaxis], columns], rotOrder)
+            quats = BVHRotations.quatSlerp(quats0, quats1, weights[rows,np.newaxis])
+            
+            axisAngles = BVHRotations.quatToEuler(quats, rotOrder)
+            referenceAngles = newMotion[rows[:,np.newaxis,np.newaxis], columns]
+            newMotion[rows[:,np.newaxis,np.newaxis], columns] = BVHRotations.matchEulerAngles(axisAngles, referenceAngles)
+        
+        return newMotion
+
+    def resampleTransMats(self, frames0, frames1, weights):
+        
+        # Interpolate the computed global transforms between frames frames0 and frames1:
+        # slerp of the rotations and linear interpolation of the translations.
+        # Returns (frames, joints, 4, 4). A lazy clip only evaluates the frames needed
+        self.updatePoses()
+        if self.lazy:
+            neededFrames, indices = np.unique(np.concatenate([frames0, frames1]), return_inverse=True)
+            sourceMats = self.computeTransMats(neededFrames)
+            frames0, frames1 = indices[:len(frames0)], indices[len(frames0):]
+        else:
+            sourceMats = self.globalTransMats
+        
+        transMats0 = np.asarray(sourceMats[frames0], dtype=np.float64)
+        transMats1 = np.asarray(sourceMats[frames1], dtype=np.float64)
+        jointWeights = np.broadcast_to(weights[:,np.newaxis], transMats0.shape[0:2])
+        
+        quats = BVHRotations.quatSlerp(BVHRotations.matToQuat(transMats0[...,0:3,0:3]),
+                                       BVHRotations.matToQuat(transMats1[...,0:3,0:3]), jointWeights)
+        
+        transMats = np.zeros(transMats0.shape, dtype=self.dtype)
+        transMats[...,0:3,0:3] = BVHRotations.quatToMat(quats)
+        transMats[...,0:3,3] = transMats0[...,0:3,3] + jointWeights[...,np.newaxis] * (transMats1[...,0:3,3] - transMats0[...,0:3,3])
+        transMats[...,3,3] = 1
+        
+        return transMats
+
     def makeRotMat(self, axisAngles):
         
         # Make a composite rotation matrix from axis angles x,y,z
@@ -405,6 +1701,128 @@ class BVHData:
         return transform
     
 
+    def makeRotMats(self, axisAngles, rotOrder):
+        
+        # Batched version of makeRotMat. axisAngles is (F,len(rotOrder)) in degrees,
+        # with the columns in the same order as rotOrder, e.g. 'ZXY' gives Rz*Rx*Ry.
+        # Returns (F,3,3) rotation matrices - one per frame. Any leading dimensions
+        # work, e.g. (F,joints,3) angles give (F,joints,3,3)
+        axisRads = np.radians(np.asarray(axisAngles, dtype=np.float64))
+        batchShape = axisRads.shape[:-1]
+        
+        rotMats = np.zeros(batchShape + (3,3))
+        rotMats[:] = np.eye(3)
+        
+        for i in range(len(rotOrder)):
+            cosA = np.cos(axisRads[...,i])
+            sinA = np.sin(axisRads[...,i])
+            R = np.zeros(batchShape + (3,3))
+            
+            if rotOrder[i] == 'X':
+                R[...,0,0] = 1
+                R[...,1,1] = cosA
+                R[...,1,2] = - sinA
+                R[...,2,1] = sinA
+                R[...,2,2] = cosA
+            elif rotOrder[i] == 'Y':
+                R[...,0,0] = cosA
+                R[...,0,2] = sinA
+                R[...,1,1] = 1
+                R[...,2,0] = - sinA
+                R[...,2,2] = cosA
+            else:
+                R[...,0,0] = cosA
+                R[...,0,1] = - sinA
+                R[...,1,0] = sinA
+                R[...,1,1] = cosA
+                R[...,2,2] = 1
+            
+            # Concatenate rotations in the order given by the channels
+            rotMats = np.matmul(rotMats, R)
+        
+        return rotMats
+
+    def invertRigidTransMats(self, transMats):
+        
+        # Invert a stack (...,4,4) of rotation + translation transforms in one go. For a rigid
+        # transform [R t; 0 1] the inverse is [R' -R't; 0 1], so no general inversion is needed
+        rotTransposed = np.swapaxes(transMats[...,0:3,0:3], -1, -2)
+        
+        inverseMats = np.zeros(np.shape(transMats), dtype=transMats.dtype)
+        inverseMats[...,0:3,0:3] = rotTransposed
+        inverseMats[...,0:3,3] = - np.matmul(rotTransposed, transMats[...,0:3,3,np.newaxis])[...,0]
+        inverseMats[...,3,3] = 1
+        
+        return inverseMats
+
+    def getBoneSegments(self, start=0, stop=None, step=1):
+        
+        # Every bone (parent joint to child joint) for frames start:stop:step as one
+        # (frames, bones, 2, 3) array of joint coordinates. Bones are in the order of
+        # their child joint, i.e. joint order without the root
+        parents = self.jointParents
+        bones = np.nonzero(parents >= 0)[0]
+        
+        self.updatePoses()
+        if self.lazy:
+            jointCoords = self.getPoses(start, stop, step)[:,:,0:3,3]
+        else:
+            jointCoords = self.jointPositions[start:stop:step]
+        
+        segments = np.empty((jointCoords.shape[0], len(bones), 2, 3), dtype=jointCoords.dtype)
+        segments[:,:,0] = jointCoords[:,parents[bones]]
+        segments[:,:,1] = jointCoords[:,bones]
+        
+        return segments
+
+    def bvhRender(self, outputFileName=None, frameStep=1, start=0, stop=None, workers=1, fps=30,
+                  figSize=(4,4), dpi=80, chunkSize=64):
+        
+        '''
+        # Render the skeleton offscreen (no display needed) to a GIF, or to a video through
+        # ffmpeg for any other extension (e.g. .mp4). For batch previews/thumbnails.
+        #
+        #   outputFileName - defaults to <bvh file>.gif
+        #   frameStep, start, stop - frames to render, as range(start, stop, frameStep)
+        #   workers - render chunks of chunkSize frames in this many parallel worker
+        #             processes, written out in order as they finish
+        #   figSize, dpi - size of the frames (default 320x320 pixels)
+        #
+        # Bones come from getBoneSegments, so a frame is drawn by updating one collection
+        # artist and blitting it over a pre-rendered background (see renderFrames).
+        # Frames are written as they are drawn (see FrameWriter), so only a few chunks of
+        # images are ever held in memory, however long the clip.
+        '''
+        if outputFileName is None:
+            outputFileName = "{}.gif".format(self.fileName)
+        
+        # NB swapping Y and Z as Y is up and not Z
+        segments = self.getBoneSegments(start, stop, frameStep)[...,[0,2,1]]
+        if segments.shape[0] == 0:
+            raise ValueError('No frames to render')
+        
+        allCoords = segments.reshape(-1,3)
+        bounds = (allCoords.min(axis=0), allCoords.max(axis=0))
+        
+        logger.info('Rendering %d frames to %s', segments.shape[0], outputFileName)
+        with self.timePhase('render'), FrameWriter(outputFileName, fps) as writer:
+            if workers > 1:
+                # Keep at most two chunks per worker in flight, so finished images don't pile
+                # up if writing is slower than rendering
+                pending = collections.deque()
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                    for chunkStart in range(0, segments.shape[0], chunkSize):
+                        pending.append(pool.submit(renderBoneSegments, segments[chunkStart:chunkStart+chunkSize],
+                                                   bounds, figSize, dpi))
+                        if len(pending) >= 2 * workers:
+                            writer.writeFrames(pending.popleft().result())
+                    while pending:
+                        writer.writeFrames(pending.popleft().result())
+            else:
+                writer.writeFrames(renderFrames(segments, bounds, figSize, dpi))
+        
+        return outputFileName
+
     def bvhDraw(self, frameStep=1):
         '''
         # Draw BVH file:
@@ -418,62 +1836,57 @@ class BVHData:
         # Once in a suitable format, FuncAnimation can be used for fast rendering.
         '''
                 
-        rootNode = self.root
-        frame = 0
-        frameStart = 0
-        frameEnd = self.totalFrames              
-        
-        # Recursively read the 'pre estimated absolte Node coords' 
-        # from the BVH Object and store parent to children connections creating a bone list.
-        # This makes for easier drawing. NB - to see how to estimate abs coords see bvhRead func.
-        for frame in range(frameStart,frameEnd,frameStep):
-                        
-            currentJointCoords = rootNode.jointCoords[frame]            
-        
-            # If there are children to the root, then start recursion to read the hierarchy
-            if len(rootNode.childNodes) > 0:
-                for i in range(len(rootNode.childNodes)):                    
-                    self.preCalculateBone(rootNode.childNodes[i], currentJointCoords, frame)               
-        
-        # Get min and max values for x, y and z axis
-        minX, maxX, minY, maxY, minZ, maxZ = 0,0,0,0,0,0
-        allX, allY, allZ = [],[],[]
-        
-        for iter in range(len(self.animationPreview)):
-            thisBone = self.animationPreview[iter]
-            for inner in range(2):
-                allX.append(thisBone[0][inner])
-                allY.append(thisBone[1][inner])
-                allZ.append(thisBone[2][inner])
-        
-        minX = min(allX)
-        maxX = max(allX)
-        minY = min(allY)
-        maxY = max(allY)
-        minZ = min(allZ)
-        maxZ = max(allZ)
+        # Drawing needs every frame, so evaluate them all if the file was read lazily
+        if self.lazy:
+            self.computeAllPoses()
+        
+        self.preCalculatePreview(frameStep)
            
-        print('Drawing BVH..')
+        logger.info('Drawing BVH..')
+        self.setupPlots()
+        
+        self.ani = animation.FuncAnimation(self.fig, self.drawSkeleton, interval=1, repeat=False)
+        plt.show()
+
+        # Create gif movie
+        outputFileName = "{}.gif"
+        outputFileName.format(bvhObject.fileName)
+        logger.info('Writing %s', outputFileName.format(bvhObject.fileName))
+        self.ani.save(outputFileName.format(bvhObject.fileName), writer=animation.PillowWriter(fps=30))
+
+    def preCalculatePreview(self, frameStep=1):
+        
+        # Build animationPreview - the list of bones (parent to child joint coords) for
+        # every frameStep'th frame, ready for drawSkeleton. Each bone is
+        # [[x0,x1],[y0,y1],[z0,z1]], frame by frame, bones in the order of their child joint.
+        # All bones of all frames come from one getBoneSegments array - no per frame walk
+        # of the hierarchy
+        segments = self.getBoneSegments(0, self.totalFrames, frameStep)
+        self.animationPreview = np.swapaxes(segments, 2, 3).reshape(-1, 3, 2).tolist()
+
+    def setupPlots(self):
+        
+        # Create the figure, with axis limits from the bones in animationPreview, and
+        # the plot objects drawSkeleton updates every frame
+        
+        # Get min and max values for x, y and z axis - bones are (bones, xyz, 2) as one array
+        allBones = np.asarray(self.animationPreview)
+        minX, minY, minZ = allBones.min(axis=(0,2))
+        maxX, maxY, maxZ = allBones.max(axis=(0,2))
+        
         self.fig = plt.figure()
         
         # NB swapping Y and Z as Y is up and not Z
-        self.ax = self.fig.add_subplot(projection="3d",xlim=(minX, maxX), ylim=(minZ, maxZ), zLim=(minY,maxY))
+        self.ax = self.fig.add_subplot(projection="3d",xlim=(minX, maxX), ylim=(minZ, maxZ), zlim=(minY,maxY))
                      
         # Create plot objects per bone that can be updated with data in the drawSkeleton func (via FuncAnimation)
         # This makes for super fast rendering
+        self.jointPlots = []
+        self.bonePlots = []
         for jointNum in range(self.totalJoints):
             # 3D plots can't contain empty arrays - so have to initialise
             self.jointPlots.append(self.ax.plot3D([0,0],[0,0],[0,0],'blue'))
             self.bonePlots.append(self.ax.plot3D([0,0],[0,0],[0,0],'ro'))
-        
-        self.ani = animation.FuncAnimation(self.fig, self.drawSkeleton, interval=1, repeat=False)
-        plt.show()
-
-        # Create gif movie
-        outputFileName = "{}.gif"
-        outputFileName.format(bvhObject.fileName)
-        print('Writing ',outputFileName.format(bvhObject.fileName))
-        self.ani.save(outputFileName.format(bvhObject.fileName), writer=animation.PillowWriter(fps=30))
 
     def drawSkeleton(self, frame):
                 
@@ -493,24 +1906,149 @@ class BVHData:
 
     def preCalculateBone(self, currentNode, lastJointCoords, frame):        
         
-        # Put all the bones in a list recursively to make drawing easier
-        # While there are children to process, do one, then recurse to process further down the hierarchy
-        if len(currentNode.childNodes) > 0:
-                       
-            currentJoint = currentNode.jointCoords[frame]   
-            self.animationPreview.append([[lastJointCoords[0],currentJoint[0]],[lastJointCoords[1],currentJoint[1]],[lastJointCoords[2],currentJoint[2]]])            
+        # Append the bones of currentNode's subtree for one frame to animationPreview, given
+        # the coordinates of currentNode's parent. The subtree is a contiguous range of
+        # joints, so this is a loop over joint indices rather than recursion
+        jointCoords = self.getPose(frame)[:,0:3,3]
+        for jointIndex in range(currentNode.jointIndex, self.subtreeStops[currentNode.jointIndex]):
+            parent = self.jointParents[jointIndex]
+            parentCoords = lastJointCoords if jointIndex == currentNode.jointIndex else jointCoords[parent]
+            currentJoint = jointCoords[jointIndex]
+            self.animationPreview.append([[parentCoords[0],currentJoint[0]],[parentCoords[1],currentJoint[1]],[parentCoords[2],currentJoint[2]]])
+
+def renderFrames(segments, bounds, figSize=(4,4), dpi=80):
+    
+    # Render (frames, bones, 2, 3) bone segments offscreen, yielding a (height, width, 3) RGB
+    # image per frame. The axes are drawn once and copied as a background, then each frame
+    # only restores that background and draws the bones (one collection) and joints (one line).
+    fig = matplotlib.figure.Figure(figsize=figSize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(projection="3d", xlim=(bounds[0][0], bounds[1][0]), ylim=(bounds[0][1], bounds[1][1]),
+                         zlim=(bounds[0][2], bounds[1][2]))
+    
+    bonePlot = Line3DCollection(segments[0], colors='blue', animated=True)
+    ax.add_collection3d(bonePlot, autolim=False)
+    jointPlot, = ax.plot3D([0], [0], [0], 'ro', markersize=2, animated=True)
+    
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    
+    for frame in range(segments.shape[0]):
+        canvas.restore_region(background)
+        
+        bonePlot.set_segments(segments[frame])
+        bonePlot.do_3d_projection()
+        jointPlot.set_data_3d(*segments[frame].reshape(-1,3).T)
+        ax.draw_artist(bonePlot)
+        ax.draw_artist(jointPlot)
+        
+        yield np.array(np.asarray(canvas.buffer_rgba())[:,:,:3])
+
+def renderBoneSegments(segments, bounds, figSize=(4,4), dpi=80):
+    
+    # renderFrames for a chunk of frames, as one (frames, height, width, 3) array.
+    # A module function (not a method) so it can run in worker processes (see bvhRender)
+    return np.stack(list(renderFrames(segments, bounds, figSize, dpi)))
+
+class FrameWriter:
+    
+    # Write RGB images one at a time as a GIF or, for any other extension, a video by piping
+    # raw frames to ffmpeg - nothing is kept once a frame is written. Use as a context
+    # manager, e.g.
+    #
+    #   with FrameWriter('preview.gif', fps=30) as writer:
+    #       writer.writeFrames(renderFrames(segments, bounds))
+    #
+    # Pillow's GIF save collects every frame before writing, so GIFs are written here with
+    # its getheader/getdata helpers instead. As Pillow does, each frame has its own adaptive
+    # palette (a local color table) and only the box of pixels changed since the previous
+    # frame is stored, so only the previous frame is kept
+    def __init__(self, outputFileName, fps=30):
+        self.outputFileName = outputFileName
+        self.fps = fps
+        self.isGif = outputFileName.lower().endswith('.gif')
+        self.outputFile = None # GIF file
+        self.process = None # ffmpeg
+        self.frameCount = 0
+        self.previousFrame = None # last GIF frame, to store only what changed
+        
+        if not self.isGif and shutil.which('ffmpeg') is None:
+            raise RuntimeError('ffmpeg is needed to write ' + outputFileName + ' (or write a .gif)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close(abort=excType is not None)
+
+    def open(self, height, width):
         
-            for i in range(len(currentNode.childNodes)):
-                self.preCalculateBone(currentNode.childNodes[i], currentJoint, frame)
+        # Start the output on the first frame, once the image size is known
+        if self.isGif:
+            self.outputFile = open(self.outputFileName, 'wb')
+            return
+        
+        command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', '{}x{}'.format(width, height), '-r', str(self.fps), '-i', '-',
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', self.outputFileName]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def writeFrame(self, frame):
+        
+        # Write one (height, width, 3) uint8 RGB image
+        if self.frameCount == 0:
+            self.open(*frame.shape[:2])
+        self.frameCount += 1
+        
+        if not self.isGif:
+            self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+            return
+        
+        from PIL import Image, GifImagePlugin
+        top, left, bottom, right = 0, 0, frame.shape[0], frame.shape[1]
+        if self.previousFrame is not None:
+            changed = np.any(frame != self.previousFrame, axis=2)
+            rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+            if len(rows) == 0: # same image again - one pixel keeps the frame's duration
+                top, left, bottom, right = 0, 0, 1, 1
             else:
-                return
-        else:            
-            currentJoint = currentNode.jointCoords[frame]
-            self.animationPreview.append([[lastJointCoords[0],currentJoint[0]],[lastJointCoords[1],currentJoint[1]],[lastJointCoords[2],currentJoint[2]]])            
-            
+                top, left, bottom, right = rows[0], cols[0], rows[-1] + 1, cols[-1] + 1
+        self.previousFrame = np.array(frame)
+        
+        image = Image.fromarray(self.previousFrame[top:bottom, left:right]).convert('P', palette=Image.Palette.ADAPTIVE)
+        if self.frameCount == 1:
+            header, usedColors = GifImagePlugin.getheader(image, info={'loop': 0, 'duration': 1000.0/self.fps})
+            self.outputFile.write(b''.join(header))
+        for data in GifImagePlugin.getdata(image, (int(left), int(top)), duration=1000.0/self.fps,
+                                           include_color_table=True):
+            self.outputFile.write(data)
+
+    def writeFrames(self, frames):
+        
+        # Write images from an array or any iterable of them, e.g. renderFrames
+        for frame in frames:
+            self.writeFrame(frame)
+
+    def close(self, abort=False):
+        
+        # Finish the file. Raises if ffmpeg failed. With abort (an error while rendering)
+        # ffmpeg is stopped and the partly written file is left as it is
+        if self.outputFile is not None:
+            if not abort:
+                self.outputFile.write(b';') # GIF trailer
+            self.outputFile.close()
+            self.outputFile = None
         
+        if self.process is not None:
+            process, self.process = self.process, None
+            if abort:
+                process.kill()
+            process.stdin.close()
+            if process.wait() != 0 and not abort:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     print('BVHData \'main\' is running the default demo..')
     print('Run as a program, this will run through basic usage.')
     print('System inputs', sys.argv)
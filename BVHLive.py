@@ -0,0 +1,471 @@
+'''
+BVHLive - live ingestion of BVH frames from an asyncio stream, with incremental FK
+
+Usage Example:
+    async def main():
+        server = await startReplayServer('01_01.bvh', port=8765) # stand-in for the stage system
+
+        live = BVHLive()
+        live.subscribe(lambda frame, pose: print(frame, pose[0,0:3,3]))
+        await live.connect('127.0.0.1', 8765) # returns when the stream closes
+
+    async def consumer(live):
+        async for frame, pose in live.poses(): # newest pose, skipping any we were too slow for
+            ...
+
+    python BVHLive.py --serve 01_01.bvh --port 8765 --repeat
+    python BVHLive.py --connect 127.0.0.1:8765
+
+The stream is a BVH file sent as text: the HIERARCHY up to and including MOTION, the
+Frames: and Frame Time: lines, then frame rows for as long as the source runs. A live
+source cannot know its length, so the Frames: count is ignored - totalFrames counts the
+rows received so far. Anything with an asyncio style `await read(n)` can be ingested: a
+StreamReader from asyncio.open_connection, a pipe (see pipeReader) or a FileFollower
+tailing a file that is still being written.
+
+Whatever has arrived since the last read (at most readSize bytes) is parsed as one batch,
+forward kinematics is run for just those frames and the newest pose is published. When
+frames arrive faster than they are processed the batches get bigger instead of queueing
+up, so subscribers are never more than one batch behind the stream. The motion and pose
+buffers grow by doubling. With keepFrames set only the most recent frames are kept, so
+memory stays bounded over a long take.
+
+The clip itself is an ordinary BVHData object (live.bvhObject) holding stream frames
+live.firstFrame onwards - getPose/getPoses/getBoneSegments, editChannels etc can be used
+on it between batches.
+'''
+
+import argparse
+import asyncio
+import io
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from BVHData import BVHData
+
+class BVHLive:
+
+    def __init__(self, bvhObject=None, capacity=1024, keepFrames=None, readSize=64 * 2**10):
+
+        # bvhObject - BVHData to fill (default: a new one). Its dtype, fkWorkers/fkChunkSize
+        #             and bindPoseFrame (a stream frame number) are used as set
+        # capacity - initial size of the frame buffers
+        # keepFrames - if set, frames older than the newest keepFrames may be dropped
+        # readSize - most bytes read, and so parsed, in one batch
+        self.bvhObject = BVHData() if bvhObject is None else bvhObject
+        self.capacity = max(1, capacity)
+        self.keepFrames = keepFrames
+        self.readSize = readSize
+
+        self.firstFrame = 0 # stream frame number of bvhObject frame 0 (earlier frames were dropped)
+        self.numChannels = 0
+        self.motionBuffer = np.zeros((0, 0)) # (capacity, channels) - allMotion is a view of the filled rows
+        self.transBuffer = np.zeros((0, 0, 4, 4)) # (capacity, joints, 4, 4) - likewise globalTransMats
+        self.positionBuffer = np.zeros((0, 0, 3)) # (capacity, joints, 3) - likewise jointPositions
+        self.pending = b'' # start of a row not yet terminated by a newline
+        self.lineNumber = 0 # line number of the next row in the stream (for error messages)
+
+        self.subscribers = []
+        self.frameEvent = None # asyncio.Event set (and replaced) whenever frames are published
+        self.closed = False # set when the ingested stream ends
+        self.latency = 0.0 # seconds from receiving the last batch to publishing its newest pose
+        self.maxLatency = 0.0
+
+    def subscribe(self, callback):
+
+        # Call callback(frame, pose) with the newest pose - a (joints, 4, 4) copy of the global
+        # transforms of stream frame number frame - after every batch. Callbacks run in the
+        # ingesting task, so they should be quick (use poses() for slow consumers).
+        # Returns callback, so it can be used as a decorator
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+
+        self.subscribers.remove(callback)
+
+    def latestFrame(self):
+
+        # Stream frame number of the newest frame received (-1 before the first frame)
+        return self.firstFrame + self.bvhObject.totalFrames - 1
+
+    def latestPose(self):
+
+        # (joints, 4, 4) global transforms of the newest frame, or None before the first frame
+        if self.bvhObject.totalFrames == 0:
+            return None
+        return self.bvhObject.globalTransMats[-1].copy()
+
+    async def poses(self):
+
+        # Async generator of (frame, pose) for the newest frame each time new frames arrive.
+        # A consumer slower than the stream skips frames rather than falling behind.
+        # Stops when the stream closes
+        if self.frameEvent is None:
+            self.frameEvent = asyncio.Event()
+
+        lastFrame = -1
+        while True:
+            event = self.frameEvent
+            frame = self.latestFrame()
+            if frame > lastFrame:
+                lastFrame = frame
+                yield frame, self.latestPose()
+            elif self.closed:
+                return
+            else:
+                await event.wait()
+
+    async def connect(self, host, port):
+
+        # Ingest the stream served at host:port until it closes
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            await self.ingest(reader, '{}:{}'.format(host, port))
+        finally:
+            writer.close()
+
+    async def ingest(self, reader, name='live'):
+
+        '''
+        # Read the HIERARCHY from reader (anything with `await reader.read(n)` returning bytes,
+        # b'' at the end of the stream), then ingest frame rows until the stream ends.
+        # name is used as bvhObject.fileName (in error messages).
+        #
+        # Each read returns whatever has arrived, up to readSize bytes. The complete rows in
+        # it are appended as one batch (see appendFrames), and any partial row is kept for
+        # the next read. Malformed rows raise a ValueError as in bvhRead.
+        '''
+        if self.frameEvent is None:
+            self.frameEvent = asyncio.Event()
+        self.closed = False
+        self.pending = b''
+        self.bvhObject.fileName = name
+
+        try:
+            await self.readHeader(reader)
+
+            while True:
+                data = await reader.read(self.readSize)
+                received = time.perf_counter()
+                if not data:
+                    break
+
+                lines = (self.pending + data).split(b'\n')
+                self.pending = lines.pop()
+                if lines:
+                    self.appendLines(lines)
+                    self.latency = time.perf_counter() - received
+                    self.maxLatency = max(self.maxLatency, self.latency)
+
+            if self.pending.strip():
+                self.appendLines([self.pending])
+            self.pending = b''
+        finally:
+            self.closed = True
+            self.frameEvent.set()
+
+    async def readLine(self, reader):
+
+        # Next line of the stream as a string (without the newline), None at the end
+        while b'\n' not in self.pending:
+            data = await reader.read(self.readSize)
+            if not data:
+                line, self.pending = self.pending, b''
+                return line.decode().rstrip('\r') if line else None
+            self.pending += data
+
+        line, self.pending = self.pending.split(b'\n', 1)
+        return line.decode().rstrip('\r')
+
+    async def readHeader(self, reader):
+
+        # Read the HIERARCHY, MOTION, Frames: and Frame Time: lines and set up bvhObject and
+        # the frame buffers for an empty clip
+        lines = []
+        while not lines or lines[-1].split()[:1] != ['MOTION']:
+            line = await self.readLine(reader)
+            if line is None:
+                raise ValueError('No MOTION section found in ' + self.bvhObject.fileName)
+            lines.append(line)
+        for i in range(2):
+            line = await self.readLine(reader)
+            if line is None:
+                raise ValueError('Stream {} ended in the MOTION header'.format(self.bvhObject.fileName))
+            lines.append(line)
+
+        self.setHierarchy('\n'.join(lines) + '\n')
+
+    def setHierarchy(self, headerText):
+
+        # Set up bvhObject from the text of a BVH file up to and including the Frame Time:
+        # line, with no frames yet. Frames are then added with appendFrames
+        bvhObject = self.bvhObject
+        bvhObject.resetStats()
+        bvhFile = io.StringIO(headerText)
+        bvhObject.readHierarchyLines(bvhFile)
+        self.lineNumber = bvhObject.readMotionHeader(bvhFile, len(bvhObject.allLines))
+        bvhObject.counters['linesParsed'] += self.lineNumber - 1
+
+        self.numChannels = bvhObject.countChannels()
+        bvhObject.allMotion = np.zeros((0, self.numChannels))
+        with bvhObject.timePhase('hierarchy'):
+            bvhObject.readHierarchy()
+        bvhObject.lazy = False
+        bvhObject.dirtyRanges = []
+        bvhObject.bindTfrms = []
+
+        self.firstFrame = 0
+        self.motionBuffer = np.zeros((self.capacity, self.numChannels))
+        self.transBuffer = np.zeros((self.capacity, bvhObject.totalJoints, 4, 4), dtype=bvhObject.dtype)
+        self.positionBuffer = np.zeros((self.capacity, bvhObject.totalJoints, 3), dtype=bvhObject.dtype)
+        self.setFrameCount(0)
+
+    def setFrameCount(self, numFrames):
+
+        # Point bvhObject's arrays at the first numFrames rows of the buffers
+        bvhObject = self.bvhObject
+        bvhObject.setMotion(self.motionBuffer[:numFrames])
+        bvhObject.globalTransMats = self.transBuffer[:numFrames]
+        bvhObject.jointPositions = self.positionBuffer[:numFrames]
+        bvhObject.totalFrames = numFrames
+        bvhObject.counters['frames'] = numFrames
+
+    def reserve(self, numFrames):
+
+        # Make room for numFrames more frames. With keepFrames set and the buffers at least
+        # twice that size, the oldest frames are dropped so the newest keepFrames are kept -
+        # each drop then frees at least as many rows as it moves. Otherwise the buffers grow
+        # to double their size, so both are amortized O(1) per frame
+        numKept = self.bvhObject.totalFrames
+        if numKept + numFrames <= self.capacity:
+            return
+
+        if self.keepFrames is not None and numKept > self.keepFrames and self.capacity >= 2 * self.keepFrames:
+            self.dropFrames(numKept - self.keepFrames)
+            numKept = self.keepFrames
+
+        if numKept + numFrames > self.capacity:
+            self.capacity = max(numKept + numFrames, 2 * self.capacity)
+            for name in ['motionBuffer', 'transBuffer', 'positionBuffer']:
+                oldBuffer = getattr(self, name)
+                newBuffer = np.zeros((self.capacity,) + oldBuffer.shape[1:], dtype=oldBuffer.dtype)
+                newBuffer[:numKept] = oldBuffer[:numKept]
+                setattr(self, name, newBuffer)
+            self.setFrameCount(numKept)
+
+    def dropFrames(self, numFrames):
+
+        # Drop the oldest numFrames frames, moving the rest to the front of the buffers.
+        # Frame numbers in bvhObject (and its bindPoseFrame) move down by numFrames
+        bvhObject = self.bvhObject
+        numKept = bvhObject.totalFrames - numFrames
+        bvhObject.updatePoses()
+        for buffer in [self.motionBuffer, self.transBuffer, self.positionBuffer]:
+            buffer[:numKept] = buffer[numFrames:numFrames + numKept]
+        self.firstFrame += numFrames
+        bvhObject.bindPoseFrame -= numFrames
+        self.setFrameCount(numKept)
+
+    def appendLines(self, lines):
+
+        # Parse a batch of frame rows (bytes or strings) and append them
+        lines = [line.decode() if isinstance(line, bytes) else line for line in lines]
+        bvhObject = self.bvhObject
+        try:
+            with bvhObject.timePhase('parse'), warnings.catch_warnings():
+                warnings.simplefilter('ignore') # loadtxt warns on a batch of blank lines
+                motion = np.loadtxt(lines, dtype=np.float64, ndmin=2)
+        except ValueError:
+            bvhObject.checkMotionRows(lines, self.lineNumber, self.numChannels)
+            raise
+        bvhObject.counters['linesParsed'] += len(lines)
+
+        if motion.shape[0] and motion.shape[1] != self.numChannels:
+            bvhObject.checkMotionRows(lines, self.lineNumber, self.numChannels)
+        self.lineNumber += len(lines)
+
+        if motion.shape[0]:
+            self.appendFrames(motion)
+
+    def appendFrames(self, motion):
+
+        # Append (frames, channels) rows of channel values, run forward kinematics for just
+        # those frames and publish the newest pose. Can also be called directly, e.g. from a
+        # source that already delivers numbers
+        motion = np.asarray(motion, dtype=np.float64).reshape(-1, self.numChannels)
+        numFrames = motion.shape[0]
+        if numFrames == 0:
+            return
+
+        bvhObject = self.bvhObject
+        self.reserve(numFrames)
+        start = bvhObject.totalFrames
+        stop = start + numFrames
+        self.motionBuffer[start:stop] = motion
+        self.setFrameCount(stop)
+
+        transMats = bvhObject.computeTransMats(slice(start, stop))
+        self.transBuffer[start:stop] = transMats
+        self.positionBuffer[start:stop] = transMats[:,:,0:3,3]
+
+        if len(bvhObject.bindTfrms) == 0 and start <= bvhObject.bindPoseFrame < stop:
+            bvhObject.storeBindPoses()
+
+        self.publish()
+
+    def publish(self):
+
+        # Hand the newest pose to the subscribers and wake up any poses() consumers
+        frame, pose = self.latestFrame(), self.latestPose()
+        for callback in list(self.subscribers):
+            callback(frame, pose)
+
+        if self.frameEvent is not None:
+            self.frameEvent.set()
+            self.frameEvent = asyncio.Event()
+
+class FileFollower:
+
+    # Reads a file that is still being written, like tail -f, as an asyncio style reader for
+    # BVHLive.ingest. At the end of the file read waits for more data instead of returning
+    # b''. The end of the stream (b'') comes after stop(), or after idleTimeout seconds with
+    # no new data if it is set
+    def __init__(self, fileName, pollInterval=0.01, idleTimeout=None):
+
+        self.file = open(fileName, 'rb')
+        self.pollInterval = pollInterval
+        self.idleTimeout = idleTimeout
+        self.stopped = False
+
+    def stop(self):
+
+        self.stopped = True
+
+    async def read(self, n=-1):
+
+        idleSeconds = 0.0
+        while True:
+            data = self.file.read(n)
+            if data:
+                return data
+            if self.stopped or (self.idleTimeout is not None and idleSeconds >= self.idleTimeout):
+                self.file.close()
+                return b''
+            await asyncio.sleep(self.pollInterval)
+            idleSeconds += self.pollInterval
+
+async def pipeReader(pipe):
+
+    # asyncio StreamReader for a pipe (file object), e.g. sys.stdin or a subprocess stdout
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader
+
+def readReplayClip(fileName):
+
+    # Split a BVH file into its header (bytes up to and including the Frame Time: line),
+    # its frame time and a list of its frame rows (bytes, with newlines)
+    with open(fileName, 'rb') as bvhFile:
+        header = []
+        for line in bvhFile:
+            header.append(line)
+            if line.split()[:1] == [b'MOTION']:
+                break
+        header += [bvhFile.readline(), bvhFile.readline()]
+        frameTime = float(header[-1].split()[2])
+        rows = [line if line.endswith(b'\n') else line + b'\n' for line in bvhFile if line.strip()]
+
+    return b''.join(header), frameTime, rows
+
+async def replayClip(fileName, writer, speed=1.0, repeat=False):
+
+    # Write a BVH file to an asyncio StreamWriter the way a live source would: the header
+    # at once, then the frame rows in real time (Frame Time / speed seconds per frame, or as
+    # fast as the reader takes them if speed is None). With repeat the frames loop forever
+    header, frameTime, rows = readReplayClip(fileName)
+    writer.write(header)
+    await writer.drain()
+    if not rows:
+        return
+
+    start = time.perf_counter()
+    sent = 0
+    while repeat or sent < len(rows):
+        if speed is None:
+            due = sent + 256
+        else:
+            due = int((time.perf_counter() - start) * speed / frameTime) + 1
+        if not repeat:
+            due = min(due, len(rows))
+
+        if due > sent:
+            writer.write(b''.join([rows[frame % len(rows)] for frame in range(sent, due)]))
+            sent = due
+            await writer.drain()
+        if speed is None:
+            await asyncio.sleep(0) # let other tasks run
+        else:
+            await asyncio.sleep(max(0.0, start + sent * frameTime / speed - time.perf_counter()))
+
+async def startReplayServer(fileName, host='127.0.0.1', port=0, speed=1.0, repeat=False):
+
+    # Serve a BVH file as a live stream (see replayClip) to every client connecting to
+    # host:port - a local stand-in for the stage system. Port 0 picks a free port, found with
+    # server.sockets[0].getsockname()[1]. Returns the asyncio Server
+    async def serveClient(reader, writer):
+        try:
+            await replayClip(fileName, writer, speed, repeat)
+        except ConnectionError:
+            pass # the client went away
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(serveClient, host, port)
+
+async def main(args):
+
+    if args.serve:
+        server = await startReplayServer(args.serve, args.host, args.port, args.speed or None, args.repeat)
+        print('Replaying', args.serve, 'on {}:{}'.format(*server.sockets[0].getsockname()[0:2]), file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+    live = BVHLive(keepFrames=args.keep_frames)
+    lastReport = [time.perf_counter(), 0]
+
+    @live.subscribe
+    def report(frame, pose):
+        now = time.perf_counter()
+        if now - lastReport[0] >= 1.0:
+            print('frame {} - {:.1f} frames/s, latency {:.2f}ms (max {:.2f}ms), root at {}'.format(
+                frame, (frame - lastReport[1]) / (now - lastReport[0]), live.latency * 1e3, live.maxLatency * 1e3,
+                np.round(pose[0,0:3,3], 2)))
+            lastReport[:] = [now, frame]
+
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        await live.connect(host, int(port))
+    elif args.follow:
+        await live.ingest(FileFollower(args.follow, idleTimeout=args.idle_timeout), args.follow)
+    else:
+        await live.ingest(await pipeReader(sys.stdin), 'stdin')
+
+    print('Stream closed after {} frames'.format(live.latestFrame() + 1))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a BVH file as a live stream, or ingest one (from a socket, a followed file or a pipe on stdin)')
+    parser.add_argument('--serve', metavar='FILE', help='serve FILE as a live stream')
+    parser.add_argument('--host', default='127.0.0.1', help='address to serve on')
+    parser.add_argument('--port', type=int, default=8765, help='port to serve on')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed (0 - as fast as possible)')
+    parser.add_argument('--repeat', action='store_true', help='loop the frames forever')
+    parser.add_argument('--connect', metavar='HOST:PORT', help='ingest the stream served at HOST:PORT')
+    parser.add_argument('--follow', metavar='FILE', help='ingest FILE, following it as it is written')
+    parser.add_argument('--idle-timeout', type=float, help='stop following after this many seconds without data')
+    parser.add_argument('--keep-frames', type=int, help='keep only this many of the newest frames')
+    asyncio.run(main(parser.parse_args()))
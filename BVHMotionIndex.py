@@ -0,0 +1,309 @@
+'''
+BVHMotionIndex - nearest pose search over a database of BVH clips (motion matching)
+
+Usage Example:
+    index = MotionIndex(jointNames=['lHand', 'rHand', 'lFoot', 'rFoot'])
+    for fileName in fileNames:
+        bvhObject = BVHData()
+        bvhObject.bvhRead(fileName)
+        index.addClip(bvhObject, fileName)
+    index.build()
+    index.save('walks.index.npz')
+
+    index = MotionIndex.load('walks.index.npz')
+    queryFeatures = index.clipFeatures(queryClip)        # (frames, D) raw features of a clip
+    clipIds, frames, distances = index.query(queryFeatures[10], k=5)
+
+Features of every frame (all in the character's frame - relative to the root and, with
+alignHeading, rotated so the root faces +Z. Y is up, as in the CMU files):
+    - positions  - joint positions relative to the root
+    - velocities - joint velocities (units per second)
+    - trajectory - root position on the ground (X,Z) at trajectoryTimes seconds in the
+                   future (clamped to the end of the clip)
+
+Each feature is shifted by its mean and divided by the average standard deviation of
+its group, then multiplied by the group weight, so groups are comparable whatever the
+units and number of joints. Search is a KD-tree in pure NumPy (leaves are scanned as
+whole arrays). The raw features, normalisation and tree are saved to one .npz file so
+they do not need rebuilding at startup - more clips can still be added to a loaded
+index (then build() again).
+'''
+
+import json
+
+import numpy as np
+
+FEATURE_GROUPS = ('positions', 'velocities', 'trajectory')
+
+class MotionIndex:
+
+    def __init__(self, jointNames=None, trajectoryTimes=(0.2, 0.4, 0.6), weights=None, alignHeading=True,
+                 leafSize=32):
+
+        # jointNames - joints whose positions/velocities are features (default: all but the root)
+        # trajectoryTimes - seconds ahead of each future root trajectory sample
+        # weights - {group: weight} for the FEATURE_GROUPS, default 1 each (0 drops a group)
+        # alignHeading - rotate features into the root's facing direction (about Y)
+        # leafSize - most frames in a KD-tree leaf
+        self.jointNames = None if jointNames is None else list(jointNames)
+        self.trajectoryTimes = list(trajectoryTimes)
+        self.weights = dict((group, 1.0) for group in FEATURE_GROUPS)
+        self.weights.update(weights or {})
+        self.alignHeading = alignHeading
+        self.leafSize = leafSize
+
+        self.clipIds = []
+        self.clipFeatureList = [] # raw (frames, D) features of each clip added
+        self.features = np.zeros((0, 0)) # normalised (frames, D) feature matrix, set by build
+        self.clipIndices = np.zeros(0, dtype=np.int32) # clip (into clipIds) of each row
+        self.frames = np.zeros(0, dtype=np.int32) # frame within its clip of each row
+        self.mean = None
+        self.scale = None
+        self.tree = None
+
+    def clipFeatures(self, bvhObject):
+
+        # Raw (frames, D) features of every frame of a clip, columns in FEATURE_GROUPS order
+        if self.jointNames is None:
+            featureJoints = np.flatnonzero(bvhObject.jointParents >= 0).tolist() # all but the root
+        else:
+            jointIndex = bvhObject.jointIndexByName
+            missing = [name for name in self.jointNames if name not in jointIndex]
+            if missing:
+                raise KeyError('joints not in {}: {}'.format(bvhObject.fileName, ', '.join(missing)))
+            featureJoints = [jointIndex[name] for name in self.jointNames]
+
+        globalTransMats = np.asarray(bvhObject.getPoses(), dtype=np.float64)
+        numFrames = globalTransMats.shape[0]
+        rootPositions = globalTransMats[:,0,0:3,3] # the root is joint 0
+        positions = globalTransMats[:,featureJoints][...,0:3,3]
+
+        # Root heading - the angle about Y of the root's local Z axis
+        if self.alignHeading:
+            forward = globalTransMats[:,0,0:3,2]
+            heading = np.arctan2(forward[:,0], forward[:,2])
+        else:
+            heading = np.zeros(numFrames)
+        cosH = np.cos(heading)[:,np.newaxis]
+        sinH = np.sin(heading)[:,np.newaxis]
+
+        def toCharacter(vectors):
+            # Rotate (frames, N, 3) world vectors by -heading about Y
+            rotated = vectors.copy()
+            rotated[...,0] = cosH * vectors[...,0] - sinH * vectors[...,2]
+            rotated[...,2] = sinH * vectors[...,0] + cosH * vectors[...,2]
+            return rotated
+
+        relativePositions = toCharacter(positions - rootPositions[:,np.newaxis])
+
+        if numFrames > 1:
+            velocities = toCharacter(np.gradient(positions, bvhObject.frameTime, axis=0))
+        else:
+            velocities = np.zeros_like(positions)
+
+        futureOffsets = [int(round(seconds / bvhObject.frameTime)) for seconds in self.trajectoryTimes]
+        futureFrames = np.minimum(np.arange(numFrames)[:,np.newaxis] + futureOffsets, numFrames - 1)
+        trajectory = toCharacter(rootPositions[futureFrames] - rootPositions[:,np.newaxis])[...,0::2]
+
+        return np.concatenate([relativePositions.reshape(numFrames, -1), velocities.reshape(numFrames, -1),
+                               trajectory.reshape(numFrames, -1)], axis=1)
+
+    def featureGroups(self, numFeatures):
+
+        # Column slice of each of the FEATURE_GROUPS for a feature matrix numFeatures wide
+        trajectorySize = 2 * len(self.trajectoryTimes)
+        jointSize = (numFeatures - trajectorySize) // 2
+        return {'positions': slice(0, jointSize),
+                'velocities': slice(jointSize, 2 * jointSize),
+                'trajectory': slice(2 * jointSize, numFeatures)}
+
+    def addClip(self, bvhObject, clipId=None):
+
+        # Add every frame of a clip (the poses are evaluated if it was read lazily).
+        # clipId is returned by query - the file name by default. Call build() afterwards
+        clipId = bvhObject.fileName if clipId is None else clipId
+        self.clipIds.append(str(clipId))
+        self.clipFeatureList.append(self.clipFeatures(bvhObject))
+
+    def build(self):
+
+        # Normalise the features of all the clips added so far and build the KD-tree
+        if not self.clipFeatureList:
+            raise ValueError('No clips added to the index')
+        rawFeatures = np.concatenate(self.clipFeatureList, axis=0)
+        counts = [len(clipFeatures) for clipFeatures in self.clipFeatureList]
+        self.clipIndices = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+        self.frames = np.concatenate([np.arange(count, dtype=np.int32) for count in counts])
+
+        self.mean = rawFeatures.mean(axis=0)
+        std = rawFeatures.std(axis=0)
+        self.scale = np.ones(rawFeatures.shape[1])
+        for group, columns in self.featureGroups(rawFeatures.shape[1]).items():
+            groupStd = std[columns].mean() if std[columns].size else 0
+            self.scale[columns] = self.weights[group] / groupStd if groupStd > 0 else 0
+
+        self.features = self.normalise(rawFeatures)
+        self.tree = KDTree(self.features, self.leafSize)
+
+    def normalise(self, rawFeatures):
+
+        # Raw features (from clipFeatures) to the normalised space searched
+        return (np.asarray(rawFeatures, dtype=np.float64) - self.mean) * self.scale
+
+    def query(self, rawFeatures, k=1):
+
+        # The k nearest frames to one (D,) or many (Q,D) raw feature vectors.
+        # Returns (clipIds, frames, distances), each (k,) or (Q,k), nearest first. If the
+        # index has fewer than k frames the rest are padded with '', -1 and inf
+        rawFeatures = np.asarray(rawFeatures, dtype=np.float64)
+        indices, distances = self.tree.query(self.normalise(rawFeatures.reshape(-1, rawFeatures.shape[-1])), k)
+
+        found = indices >= 0
+        clipIds = np.where(found, np.asarray(self.clipIds)[self.clipIndices[indices]], '')
+        frames = np.where(found, self.frames[indices], -1)
+        if rawFeatures.ndim == 1:
+            return clipIds[0], frames[0], distances[0]
+
+        return clipIds, frames, distances
+
+    def save(self, fileName):
+
+        # Write the index to a .npz file (no pickled objects)
+        config = {'jointNames': self.jointNames, 'trajectoryTimes': self.trajectoryTimes, 'weights': self.weights,
+                  'alignHeading': self.alignHeading, 'leafSize': self.leafSize}
+        np.savez(fileName, config=np.array(json.dumps(config)), clipIds=np.array(self.clipIds, dtype=str),
+                 rawFeatures=np.concatenate(self.clipFeatureList, axis=0), clipIndices=self.clipIndices,
+                 frames=self.frames, mean=self.mean, scale=self.scale, **self.tree.getArrays())
+
+    @classmethod
+    def load(cls, fileName):
+
+        # Read an index written by save
+        with np.load(fileName, allow_pickle=False) as arrays:
+            config = json.loads(str(arrays['config']))
+            index = cls(**config)
+            index.clipIds = [str(clipId) for clipId in arrays['clipIds']]
+            index.clipIndices = arrays['clipIndices']
+            index.frames = arrays['frames']
+            index.mean = arrays['mean']
+            index.scale = arrays['scale']
+
+            rawFeatures = arrays['rawFeatures']
+            clipStarts = np.flatnonzero(index.frames == 0)
+            index.clipFeatureList = np.split(rawFeatures, clipStarts[1:])
+            index.features = index.normalise(rawFeatures)
+            index.tree = KDTree.fromArrays(index.features, arrays)
+
+        return index
+
+class KDTree:
+
+    # KD-tree over the rows of a (N,D) array. Nodes are kept in flat arrays: a node splits
+    # on splitDims at splitValues into children left/right, or (splitDims == -1) is a leaf
+    # holding the rows order[starts:stops]
+    ARRAY_NAMES = ('order', 'splitDims', 'splitValues', 'left', 'right', 'starts', 'stops')
+
+    def __init__(self, points, leafSize=32):
+
+        self.points = np.asarray(points, dtype=np.float64)
+        self.order = np.arange(len(self.points))
+        splitDims, splitValues, left, right, starts, stops = [], [], [], [], [], []
+
+        # Built with an explicit stack of (node, start, stop) ranges of order
+        nodesToDo = [(0, 0, len(self.points))]
+        for array in (splitDims, splitValues, left, right, starts, stops):
+            array.append(0)
+        while nodesToDo:
+            node, start, stop = nodesToDo.pop()
+            starts[node], stops[node] = start, stop
+            left[node] = right[node] = -1
+            splitDims[node], splitValues[node] = -1, 0.0
+
+            rows = self.order[start:stop]
+            if stop - start <= leafSize:
+                continue
+            spread = self.points[rows].max(axis=0) - self.points[rows].min(axis=0)
+            splitDim = int(np.argmax(spread))
+            if spread[splitDim] == 0:
+                continue
+
+            # Median split - the lower half goes left
+            middle = (stop - start) // 2
+            partition = np.argpartition(self.points[rows, splitDim], middle)
+            self.order[start:stop] = rows[partition]
+            splitDims[node] = splitDim
+            splitValues[node] = float(self.points[self.order[start + middle], splitDim])
+
+            for child, childStart, childStop in ((len(starts), start, start + middle),
+                                                 (len(starts) + 1, start + middle, stop)):
+                for array in (splitDims, splitValues, left, right, starts, stops):
+                    array.append(0)
+                nodesToDo.append((child, childStart, childStop))
+            left[node], right[node] = len(starts) - 2, len(starts) - 1
+
+        self.splitDims = np.array(splitDims, dtype=np.int32)
+        self.splitValues = np.array(splitValues)
+        self.left = np.array(left, dtype=np.int32)
+        self.right = np.array(right, dtype=np.int32)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.stops = np.array(stops, dtype=np.int64)
+
+    def getArrays(self):
+
+        # The tree as named arrays (prefixed 'tree') for saving
+        return dict(('tree' + name, getattr(self, name)) for name in self.ARRAY_NAMES)
+
+    @classmethod
+    def fromArrays(cls, points, arrays):
+
+        # Rebuild a tree from getArrays output without repeating the build
+        tree = cls.__new__(cls)
+        tree.points = np.asarray(points, dtype=np.float64)
+        for name in cls.ARRAY_NAMES:
+            setattr(tree, name, arrays['tree' + name])
+
+        return tree
+
+    def query(self, queries, k=1):
+
+        # k nearest rows to each of the (Q,D) queries. Returns (Q,k) row indices and
+        # Euclidean distances, nearest first (padded with -1/inf if there are fewer rows)
+        k = int(k)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf)
+
+        for q, point in enumerate(queries):
+            bestRows = np.zeros(0, dtype=np.int64)
+            bestDists = np.zeros(0)
+            worst = np.inf
+
+            # Depth first, nearer child first. The distance to the splitting plane
+            # is a lower bound for everything on the far side
+            nodesToDo = [(0, 0.0)]
+            while nodesToDo:
+                node, bound = nodesToDo.pop()
+                if bound >= worst:
+                    continue
+
+                if self.splitDims[node] < 0:
+                    rows = self.order[self.starts[node]:self.stops[node]]
+                    dists = np.sum((self.points[rows] - point)**2, axis=1)
+                    bestRows = np.concatenate([bestRows, rows])
+                    bestDists = np.concatenate([bestDists, dists])
+                    if len(bestDists) > k:
+                        keep = np.argpartition(bestDists, k - 1)[:k]
+                        bestRows, bestDists = bestRows[keep], bestDists[keep]
+                    if len(bestDists) == k:
+                        worst = bestDists.max()
+                    continue
+
+                diff = point[self.splitDims[node]] - self.splitValues[node]
+                near, far = (self.left[node], self.right[node]) if diff < 0 else (self.right[node], self.left[node])
+                nodesToDo.append((far, max(bound, diff * diff)))
+                nodesToDo.append((near, bound))
+
+            nearest = np.argsort(bestDists, kind='stable')
+            indices[q,:len(nearest)] = bestRows[nearest]
+            distances[q,:len(nearest)] = np.sqrt(bestDists[nearest])
+
+        return indices, distances
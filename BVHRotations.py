@@ -0,0 +1,265 @@
+'''
+BVHRotations - batched rotation conversions for BVH channel data
+
+All functions work on whole arrays at once - any number of leading dimensions
+(e.g. frames, joints) - so a clip is converted without Python loops.
+
+Representations (see toRepresentation): quaternion, 3x3 matrix, continuous 6D (first two
+matrix columns) and axis-angle (rotation vector in radians).
+
+Conventions:
+    - Euler angles are in degrees, given in the order of the channels in the BVH
+      file, e.g. rotOrder 'ZXY' means R = Rz * Rx * Ry (same as makeTransMat)
+    - Quaternions are (w, x, y, z), Hamilton product
+    - Rotation matrices act on column vectors
+'''
+
+import numpy as np
+
+AXIS_INDEX = {'X': 0, 'Y': 1, 'Z': 2}
+
+def eulerToQuat(axisAngles, rotOrder):
+
+    # (..., len(rotOrder)) Euler angles in degrees to (..., 4) unit quaternions
+    halfRads = np.radians(np.asarray(axisAngles, dtype=np.float64)) / 2
+
+    # Quaternion components kept as separate contiguous arrays - [w, x, y, z]
+    quat = [np.ones(halfRads.shape[:-1]), 0, 0, 0]
+    for i in range(len(rotOrder)):
+        cosA = np.cos(halfRads[...,i])
+        sinA = np.sin(halfRads[...,i])
+
+        # Concatenate rotations in the order given by the channels. Multiplying by the
+        # rotation about axis k, with (k, a, b) cyclic, only needs these terms
+        k = AXIS_INDEX[rotOrder[i]]
+        a, b = (k + 1) % 3, (k + 2) % 3
+        w, v = quat[0], quat[1:]
+        quat = [None] * 4
+        quat[0] = w * cosA - v[k] * sinA
+        quat[1 + k] = v[k] * cosA + w * sinA
+        quat[1 + a] = v[a] * cosA + v[b] * sinA
+        quat[1 + b] = v[b] * cosA - v[a] * sinA
+
+    return np.stack(np.broadcast_arrays(*quat), axis=-1)
+
+def quatMultiply(q1, q2):
+
+    # Hamilton product of two (..., 4) quaternion arrays
+    w1, x1, y1, z1 = np.moveaxis(q1, -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(q2, -1, 0)
+
+    return np.stack([w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                     w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2], axis=-1)
+
+def quatToMat(quats):
+
+    # (..., 4) unit quaternions to (..., 3, 3) rotation matrices
+    w, x, y, z = np.moveaxis(np.asarray(quats, dtype=np.float64), -1, 0)
+
+    rotMats = np.empty(w.shape + (3, 3))
+    rotMats[...,0,0] = 1 - 2*(y*y + z*z)
+    rotMats[...,0,1] = 2*(x*y - w*z)
+    rotMats[...,0,2] = 2*(x*z + w*y)
+    rotMats[...,1,0] = 2*(x*y + w*z)
+    rotMats[...,1,1] = 1 - 2*(x*x + z*z)
+    rotMats[...,1,2] = 2*(y*z - w*x)
+    rotMats[...,2,0] = 2*(x*z - w*y)
+    rotMats[...,2,1] = 2*(y*z + w*x)
+    rotMats[...,2,2] = 1 - 2*(x*x + y*y)
+
+    return rotMats
+
+def matToQuat(rotMats):
+
+    # (..., 3, 3) rotation matrices to (..., 4) unit quaternions with w >= 0. For each matrix
+    # the largest of 4w^2, 4x^2, 4y^2, 4z^2 is used as the pivot (Shepperd's method),
+    # which keeps the conversion stable for every rotation
+    rotMats = np.asarray(rotMats, dtype=np.float64)
+    m = [[rotMats[...,i,j] for j in range(3)] for i in range(3)]
+
+    trace = m[0][0] + m[1][1] + m[2][2]
+    pivots = np.stack([trace, m[0][0], m[1][1], m[2][2]], axis=-1)
+    pivot = np.argmax(pivots, axis=-1)
+
+    # Each candidate is 4 * (pivot component) * quaternion
+    candidates = np.stack([
+        np.stack([1 + trace, m[2][1] - m[1][2], m[0][2] - m[2][0], m[1][0] - m[0][1]], axis=-1),
+        np.stack([m[2][1] - m[1][2], 1 + m[0][0] - m[1][1] - m[2][2], m[0][1] + m[1][0], m[0][2] + m[2][0]], axis=-1),
+        np.stack([m[0][2] - m[2][0], m[0][1] + m[1][0], 1 - m[0][0] + m[1][1] - m[2][2], m[1][2] + m[2][1]], axis=-1),
+        np.stack([m[1][0] - m[0][1], m[0][2] + m[2][0], m[1][2] + m[2][1], 1 - m[0][0] - m[1][1] + m[2][2]], axis=-1)],
+        axis=-2)
+
+    quats = np.take_along_axis(candidates, pivot[...,np.newaxis,np.newaxis], axis=-2)[...,0,:]
+    quats /= np.linalg.norm(quats, axis=-1, keepdims=True)
+
+    return np.where(quats[...,0:1] < 0, -quats, quats)
+
+def matToEuler(rotMats, rotOrder):
+
+    # (..., 3, 3) rotation matrices to (..., 3) Euler angles in degrees for a three axis
+    # rotOrder, i.e. the angles (a, b, c) with R = R_order[0](a) R_order[1](b) R_order[2](c).
+    # The middle angle is in [-90, 90]. At gimbal lock the last angle is set to 0
+    rotMats = np.asarray(rotMats, dtype=np.float64)
+    return eulerFromEntries(lambda row, col: rotMats[...,row,col], rotOrder)
+
+def quatToEuler(quats, rotOrder):
+
+    # (..., 4) unit quaternions to (..., 3) Euler angles in degrees (see matToEuler).
+    # Only the rotation matrix entries needed are built
+    quat = np.moveaxis(np.asarray(quats, dtype=np.float64), -1, 0)
+
+    def entry(row, col):
+        if row == col:
+            others = [axis for axis in range(3) if axis != row]
+            return 1 - 2 * (quat[1 + others[0]]**2 + quat[1 + others[1]]**2)
+        sign = -1 if (col - row) % 3 == 1 else 1
+        return 2 * (quat[1 + row] * quat[1 + col] + sign * quat[0] * quat[4 - row - col])
+
+    return eulerFromEntries(entry, rotOrder)
+
+def eulerFromEntries(entry, rotOrder):
+
+    # Euler angles from rotation matrix entries, given by entry(row, col)
+    i, j, k = [AXIS_INDEX[axis] for axis in rotOrder]
+
+    # +1 for cyclic orders (XYZ, YZX, ZXY), -1 for the others
+    parity = 1 if (j - i) % 3 == 1 else -1
+
+    sinB = np.clip(parity * entry(i, k), -1, 1)
+    angleB = np.arcsin(sinB)
+    angleA = np.arctan2(-parity * entry(j, k), entry(k, k))
+    angleC = np.arctan2(-parity * entry(i, j), entry(i, i))
+
+    # Gimbal lock - only a + c (or a - c) is defined. Put it all in the first angle
+    locked = np.abs(sinB) > 1 - 1e-12
+    if np.any(locked):
+        angleA = np.where(locked, np.arctan2(parity * entry(k, j), entry(j, j)), angleA)
+        angleC = np.where(locked, 0.0, angleC)
+
+    return np.degrees(np.stack([angleA, angleB, angleC], axis=-1))
+
+def quatContinuity(quats, axis=0):
+
+    # Flip quaternion signs along an axis (usually time) so neighbouring quaternions are
+    # in the same hemisphere (q and -q are the same rotation). Returns a new array
+    quats = np.asarray(quats, dtype=np.float64)
+    moved = np.moveaxis(quats, axis, 0)
+
+    dots = np.sum(moved[1:] * moved[:-1], axis=-1)
+    signs = np.concatenate([np.ones((1,) + dots.shape[1:]), np.cumprod(np.where(dots < 0, -1.0, 1.0), axis=0)])
+
+    return np.moveaxis(moved * signs[...,np.newaxis], 0, axis)
+
+def quatSlerp(q0, q1, t):
+
+    # Spherical linear interpolation between (..., 4) quaternion arrays, t broadcast
+    # against the leading dimensions. Takes the shortest path, falling back to normalised
+    # linear interpolation for nearly identical rotations
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.asarray(q1, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)[...,np.newaxis]
+
+    dots = np.sum(q0 * q1, axis=-1, keepdims=True)
+    q1 = np.where(dots < 0, -q1, q1)
+    dots = np.abs(dots)
+
+    angles = np.arccos(np.clip(dots, -1, 1))
+    sinAngles = np.sin(angles)
+    nearlyEqual = sinAngles < 1e-6
+    safeSin = np.where(nearlyEqual, 1, sinAngles)
+
+    w0 = np.where(nearlyEqual, 1 - t, np.sin((1 - t) * angles) / safeSin)
+    w1 = np.where(nearlyEqual, t, np.sin(t * angles) / safeSin)
+
+    quats = w0 * q0 + w1 * q1
+    return quats / np.linalg.norm(quats, axis=-1, keepdims=True)
+
+def matchEulerAngles(axisAngles, referenceAngles):
+
+    # Pick, for each (..., 3) Euler triple, the equivalent triple closest to referenceAngles:
+    # either (a, b, c) or (a + 180, 180 - b, c + 180), each angle shifted by multiples of 360.
+    # Keeps converted angles on the same branch as the source channels (e.g. 190 not -170)
+    axisAngles = np.asarray(axisAngles, dtype=np.float64)
+    referenceAngles = np.asarray(referenceAngles, dtype=np.float64)
+
+    flipped = axisAngles * [1, -1, 1] + [180, 180, 180]
+
+    candidates = []
+    for angles in (axisAngles, flipped):
+        candidates.append(referenceAngles + (angles - referenceAngles + 180) % 360 - 180)
+    distances = [np.sum(np.abs(angles - referenceAngles), axis=-1, keepdims=True) for angles in candidates]
+
+    return np.where(distances[1] < distances[0], candidates[1], candidates[0])
+
+def eulerToMat(axisAngles, rotOrder):
+
+    # (..., len(rotOrder)) Euler angles in degrees to (..., 3, 3) rotation matrices
+    return quatToMat(eulerToQuat(axisAngles, rotOrder))
+
+def matToSixD(rotMats):
+
+    # Continuous 6D representation - the first two columns of each (..., 3, 3) rotation
+    # matrix, as (..., 6): [r00, r10, r20, r01, r11, r21]
+    rotMats = np.asarray(rotMats)
+    return np.concatenate([rotMats[...,:,0], rotMats[...,:,1]], axis=-1)
+
+def sixDToMat(sixD):
+
+    # (..., 6) 6D representations (e.g. network outputs) back to (..., 3, 3) rotation
+    # matrices, by Gram-Schmidt on the two columns
+    sixD = np.asarray(sixD, dtype=np.float64)
+    col0 = sixD[...,0:3] / np.linalg.norm(sixD[...,0:3], axis=-1, keepdims=True)
+    col1 = sixD[...,3:6] - np.sum(col0 * sixD[...,3:6], axis=-1, keepdims=True) * col0
+    col1 /= np.linalg.norm(col1, axis=-1, keepdims=True)
+
+    return np.stack([col0, col1, np.cross(col0, col1)], axis=-1)
+
+def quatToAxisAngle(quats):
+
+    # (..., 4) unit quaternions to (..., 3) axis-angle (rotation vector) - the unit axis
+    # times the angle in radians, with the angle in [0, pi]
+    quats = np.asarray(quats, dtype=np.float64)
+    quats = np.where(quats[...,0:1] < 0, -quats, quats)
+
+    sinHalf = np.linalg.norm(quats[...,1:4], axis=-1, keepdims=True)
+    angles = 2 * np.arctan2(sinHalf, quats[...,0:1])
+
+    # angle / sin(angle / 2) -> 2 for small angles
+    small = sinHalf < 1e-8
+    scale = np.where(small, 2.0, angles / np.where(small, 1.0, sinHalf))
+
+    return quats[...,1:4] * scale
+
+def axisAngleToQuat(axisAngles):
+
+    # (..., 3) axis-angle (rotation vectors, radians) to (..., 4) unit quaternions
+    axisAngles = np.asarray(axisAngles, dtype=np.float64)
+    angles = np.linalg.norm(axisAngles, axis=-1, keepdims=True)
+
+    small = angles < 1e-8
+    scale = np.where(small, 0.5, np.sin(angles / 2) / np.where(small, 1.0, angles))
+
+    return np.concatenate([np.cos(angles / 2), axisAngles * scale], axis=-1)
+
+# Size of the last dimension of each representation given by toRepresentation
+REPRESENTATIONS = {'quaternion': 4, 'matrix': 9, '6d': 6, 'axisAngle': 3}
+
+def toRepresentation(quats, representation, continuous=True, axis=0):
+
+    # Convert (..., 4) quaternions to one of REPRESENTATIONS, flattened to (..., D).
+    # With continuous set, quaternion signs are made continuous along axis (time)
+    if representation not in REPRESENTATIONS:
+        raise ValueError('representation must be one of {}, not {!r}'.format(sorted(REPRESENTATIONS), representation))
+
+    if representation == 'quaternion':
+        return quatContinuity(quats, axis) if continuous else quats
+    if representation == 'axisAngle':
+        return quatToAxisAngle(quats)
+
+    rotMats = quatToMat(quats)
+    if representation == 'matrix':
+        return rotMats.reshape(rotMats.shape[:-2] + (9,))
+
+    return matToSixD(rotMats)
@@ -0,0 +1,128 @@
+'''
+BVHSkinning - linear blend skinning of a mesh by a BVHData skeleton
+
+Usage Example:
+    bvhObject = BVHData()
+    bvhObject.bindPoseFrame = 147 # frame holding the bind pose
+    bvhObject.bvhRead('skeleton_motion_jump.bvh')
+
+    skin = BVHSkin(bvhObject, vertices, jointIndices, weights)
+    deformed = skin.deform()                       # (frames, vertices, 3)
+    for startFrame, chunk in skin.deformStream():  # or a chunk of frames at a time
+        ...
+
+The mesh is given as bind pose vertices (V,3) with a fixed number K of joint
+influences per vertex: jointIndices (V,K) into the BVHData joint order and
+weights (V,K). A dense or sparse (anything with .tocsr(), e.g. scipy.sparse)
+(V, joints) weight matrix can be converted with BVHSkin.fromWeightMatrix.
+
+Skinning uses the inverse bind transforms in bvhObject.bindTfrms (computed by
+bvhRead when bindPoseFrame is set). For each frame the K skinning matrices of
+a vertex are blended first, then applied once to the vertex, all vectorised
+over a chunk of frames and every vertex.
+'''
+
+import numpy as np
+
+class BVHSkin:
+
+    def __init__(self, bvhObject, vertices, jointIndices, weights, bindTfrms=None, chunkBytes=64 * 2**20):
+
+        # bindTfrms - (joints,4,4) inverse bind transforms, if not taken from bvhObject
+        # chunkBytes - rough memory budget for a chunk of frames (sets the chunk size)
+        self.bvhObject = bvhObject
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.jointIndices = np.asarray(jointIndices, dtype=np.intp)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.chunkBytes = chunkBytes
+
+        if bindTfrms is None:
+            bindTfrms = bvhObject.bindTfrms
+        if len(bindTfrms) != bvhObject.totalJoints:
+            raise ValueError('No bind pose - set bindPoseFrame before bvhRead, or pass bindTfrms')
+        self.bindTfrms = np.asarray(bindTfrms, dtype=np.float64)
+
+        if self.jointIndices.ndim == 1:
+            self.jointIndices = self.jointIndices[:,np.newaxis]
+            self.weights = self.weights[:,np.newaxis]
+        if self.jointIndices.shape != self.weights.shape or self.jointIndices.shape[0] != self.vertices.shape[0]:
+            raise ValueError('jointIndices and weights must both be (vertices, K), got {} and {} for {} vertices'
+                             .format(self.jointIndices.shape, self.weights.shape, self.vertices.shape[0]))
+        if self.jointIndices.size and not 0 <= self.jointIndices.min() <= self.jointIndices.max() < bvhObject.totalJoints:
+            raise ValueError('jointIndices must be in the range 0..{}'.format(bvhObject.totalJoints - 1))
+
+    @classmethod
+    def fromWeightMatrix(cls, bvhObject, vertices, weightMatrix, **kwargs):
+
+        # Build a skin from a (vertices, joints) weight matrix - a dense array or a sparse
+        # matrix with .tocsr(). K is the largest number of influences on any vertex; vertices
+        # with fewer are padded with zero weights
+        if hasattr(weightMatrix, 'tocsr'):
+            csr = weightMatrix.tocsr()
+            indptr, indices, data = csr.indptr, csr.indices, csr.data
+        else:
+            dense = np.asarray(weightMatrix)
+            rows, indices = np.nonzero(dense)
+            data = dense[rows, indices]
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=dense.shape[0]))])
+
+        counts = np.diff(indptr)
+        numInfluences = max(int(counts.max()) if counts.size else 0, 1)
+
+        # Position of every nonzero within its row
+        rows = np.repeat(np.arange(len(counts)), counts)
+        slots = np.arange(len(indices)) - indptr[rows]
+
+        jointIndices = np.zeros((len(counts), numInfluences), dtype=np.intp)
+        weights = np.zeros((len(counts), numInfluences))
+        jointIndices[rows, slots] = indices
+        weights[rows, slots] = data
+
+        return cls(bvhObject, vertices, jointIndices, weights, **kwargs)
+
+    def chunkFrames(self):
+
+        # Frames per chunk so the blended (frames, vertices, 3, 4) matrices fit chunkBytes
+        return max(1, int(self.chunkBytes // max(1, self.vertices.shape[0] * 12 * 8)))
+
+    def deformFrames(self, globalTransMats):
+
+        # Skin the mesh for a block of (frames, joints, 4, 4) global transforms.
+        # Returns (frames, vertices, 3)
+        skinMats = np.matmul(np.asarray(globalTransMats, dtype=np.float64), self.bindTfrms)[:,:,0:3,:]
+
+        # Blend the K skinning matrices of every vertex: (frames, vertices, 3, 4)
+        blendedMats = np.zeros((skinMats.shape[0], self.vertices.shape[0], 3, 4))
+        for k in range(self.jointIndices.shape[1]):
+            blendedMats += self.weights[np.newaxis,:,k,np.newaxis,np.newaxis] * skinMats[:,self.jointIndices[:,k]]
+
+        return np.einsum('fvij,vj->fvi', blendedMats[...,0:3], self.vertices) + blendedMats[...,3]
+
+    def deformStream(self, start=0, stop=None, step=1, chunkSize=None):
+
+        # Generator yielding (startFrame, vertices) for chunks of frames start:stop:step, where
+        # vertices is (chunk frames, vertices, 3) and startFrame the first frame of the chunk.
+        # Only one chunk is in memory at a time. Poses come from bvhObject.getPoses, so a
+        # lazily read clip is only evaluated for the frames skinned
+        if chunkSize is None:
+            chunkSize = self.chunkFrames()
+
+        frames = range(self.bvhObject.totalFrames)[start:stop:step]
+        for chunkStart in range(0, len(frames), chunkSize):
+            chunkFrames = frames[chunkStart:chunkStart + chunkSize]
+            stopFrame = chunkFrames[-1] + (1 if chunkFrames.step > 0 else -1)
+            globalTransMats = self.bvhObject.getPoses(chunkFrames[0], stopFrame if stopFrame >= 0 else None, chunkFrames.step)
+            yield chunkFrames[0], self.deformFrames(globalTransMats).astype(self.bvhObject.dtype, copy=False)
+
+    def deform(self, start=0, stop=None, step=1, chunkSize=None):
+
+        # Deformed vertices for frames start:stop:step - (frames, vertices, 3)
+        frames = range(self.bvhObject.totalFrames)[start:stop:step]
+        deformed = np.zeros((len(frames), self.vertices.shape[0], 3), dtype=self.bvhObject.dtype)
+
+        chunkStart = 0
+        for startFrame, chunk in self.deformStream(start, stop, step, chunkSize):
+            deformed[chunkStart:chunkStart + chunk.shape[0]] = chunk
+            chunkStart += chunk.shape[0]
+
+        return deformed
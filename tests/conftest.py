@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+packageDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, packageDir)
+
+from BVHData import BVHData
+
+@pytest.fixture
+def bvhFileName():
+    return os.path.join(packageDir, '02_05.bvh')
+
+@pytest.fixture
+def bvhObject(bvhFileName):
+    bvhObject = BVHData()
+    bvhObject.bvhRead(bvhFileName)
+    return bvhObject
@@ -0,0 +1,35 @@
+import numpy as np
+
+import BVHAnalytics
+
+def test_no_contacts(bvhObject):
+    # contactSpeed 0 - no frame is slow enough, so no foot has any contact
+    stats = BVHAnalytics.clipStats(bvhObject, contactSpeed=0.0)
+    assert stats['footContacts']
+    assert all(contacts == [] for contacts in stats['footContacts'].values())
+
+def test_chunked_matches_whole_clip(bvhObject):
+    chunked = BVHAnalytics.makeClipStats(bvhObject)
+    for start in range(0, bvhObject.totalFrames, 100):
+        chunked.update(bvhObject.jointPositions[start:start+100], bvhObject.allMotion[start:start+100])
+    chunkedStats = chunked.result()
+    wholeStats = BVHAnalytics.clipStats(bvhObject)
+
+    assert chunkedStats['footContacts'] == wholeStats['footContacts']
+    assert any(wholeStats['footContacts'].values())
+    assert np.allclose(chunkedStats['rootPathLength'], wholeStats['rootPathLength'])
+    assert np.array_equal(chunkedStats['outlierFrames'], wholeStats['outlierFrames'])
+
+def test_zero_frames(bvhFileName, tmp_path):
+    # The same clip with its MOTION cut to no frames
+    with open(bvhFileName) as bvhFile:
+        lines = bvhFile.read().splitlines()
+    motionLine = lines.index('MOTION')
+    emptyFileName = str(tmp_path / 'empty.bvh')
+    with open(emptyFileName, 'w') as emptyFile:
+        emptyFile.write('\n'.join(lines[:motionLine+1] + ['Frames: 0', lines[motionLine+2]]) + '\n')
+
+    for stats in (BVHAnalytics.streamStats(emptyFileName), BVHAnalytics.streamStats(emptyFileName, contactSpeed=0.0)):
+        assert stats['totalFrames'] == 0
+        assert all(contacts == [] for contacts in stats['footContacts'].values())
+        assert len(stats['outlierFrames']) == 0
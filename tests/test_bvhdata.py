@@ -0,0 +1,89 @@
+import copy
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+import BVHData
+from BVHData import BVHData as BVHDataClass
+
+def test_pickle_round_trip(bvhObject):
+    copied = pickle.loads(pickle.dumps(bvhObject))
+    assert copied.skeleton is bvhObject.skeleton
+    assert np.array_equal(copied.allMotion, bvhObject.allMotion)
+    assert np.array_equal(copied.globalTransMats, bvhObject.globalTransMats)
+    assert copied.getJointIndex('head') == bvhObject.getJointIndex('head')
+    assert np.array_equal(copied.joints[5].jointCoords, bvhObject.joints[5].jointCoords)
+
+    node = pickle.loads(pickle.dumps(bvhObject.joints[4]))
+    assert node.name == bvhObject.joints[4].name
+
+def test_pickle_rebuilds_skeleton_in_new_process(bvhObject):
+    # With an empty template cache (as in a worker process) the Skeleton is made again
+    data = pickle.dumps(bvhObject)
+    BVHData.clearSkeletonCache()
+    copied = pickle.loads(data)
+    assert copied.skeleton.fingerprint == bvhObject.skeleton.fingerprint
+    assert dict(copied.jointIndexByName) == dict(bvhObject.jointIndexByName)
+    assert np.array_equal(copied.computeTransMats(), bvhObject.globalTransMats)
+
+def test_deepcopy(bvhObject):
+    copied = copy.deepcopy(bvhObject)
+    assert copied.joints[5].bvhData is copied
+    assert np.array_equal(copied.getPose(100), bvhObject.getPose(100))
+
+def test_pickle_lazy(bvhObject, bvhFileName):
+    lazyObject = BVHDataClass()
+    lazyObject.bvhRead(bvhFileName, lazy=True)
+    lazyObject.getPose(10)
+    copied = pickle.loads(pickle.dumps(lazyObject))
+    assert np.array_equal(copied.getPose(500), bvhObject.getPose(500))
+
+def test_write_read_round_trip_numpy_frame_time(bvhObject, tmp_path):
+    bvhObject.frameTime = np.float64(1) / 120
+    fileName = str(tmp_path / 'written.bvh')
+    bvhObject.bvhWrite(fileName, step=2)
+
+    written = BVHDataClass()
+    written.bvhRead(fileName)
+    assert type(written.frameTime) is float
+    assert written.frameTime == 2.0 / 120
+    assert written.totalFrames == len(range(0, bvhObject.totalFrames, 2))
+    assert np.allclose(written.allMotion, bvhObject.allMotion[::2])
+
+def test_resample_frame_time(bvhObject):
+    resampled = bvhObject.resample(np.float64(1) / 30)
+    assert type(resampled.frameTime) is float
+    assert resampled.frameTime == 1.0 / 30
+
+    for frameTime in (0, -1.0 / 30, np.float64(0), float('nan'), float('inf')):
+        with pytest.raises(ValueError):
+            bvhObject.resample(frameTime)
+
+def readCached(bvhFileName, cacheDir):
+    cached = BVHDataClass()
+    cached.cacheDir = cacheDir
+    cached.bvhRead(bvhFileName, useCache=True)
+    return cached
+
+@pytest.mark.parametrize('damage', ['missing', 'truncated'])
+def test_cache_recomputes_damaged_poses(bvhObject, bvhFileName, tmp_path, damage):
+    cacheDir = str(tmp_path)
+    cachePath = readCached(bvhFileName, cacheDir).getCachePath()
+
+    posesFileName = os.path.join(cachePath, 'globalTransMats.npy')
+    if damage == 'missing':
+        os.remove(posesFileName)
+    else:
+        with open(posesFileName, 'r+b') as posesFile:
+            posesFile.truncate(os.path.getsize(posesFileName) // 2)
+
+    cached = readCached(bvhFileName, cacheDir)
+    assert 'parse' not in cached.timings # still read from the cache
+    assert np.array_equal(cached.globalTransMats, bvhObject.globalTransMats)
+
+    # The entry is rewritten, so the next read maps the poses again
+    cached = readCached(bvhFileName, cacheDir)
+    assert isinstance(cached.globalTransMats, np.memmap)
+    assert np.array_equal(cached.jointPositions, bvhObject.jointPositions)